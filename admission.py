@@ -0,0 +1,104 @@
+"""
+Admission control for inbound work.
+
+Every DM (and every recognised Whispr command) takes a slot from a bounded
+pool before doing any REST work. When the pool is full, work waits in a
+bounded priority queue: commands from admins first, then replies, then new
+confessions and everyone else's commands.
+Once the queue is full too, the lowest-priority waiter is shed (possibly the
+newcomer itself) and the user is told to try again, so a burst can't turn
+into an unbounded REST storm and global 429s.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+import metrics
+
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "16"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "200"))
+
+PRIORITY_COMMAND = 0
+PRIORITY_REPLY = 1
+PRIORITY_CONFESSION = 2
+
+
+class AdmissionRejected(Exception):
+    """Raised when work is shed because the queue is full."""
+
+
+class AdmissionController:
+    def __init__(self, concurrency=ADMISSION_CONCURRENCY, queue_size=ADMISSION_QUEUE_SIZE):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters = []      # heap of [priority, seq, future, kind]
+        self._seq = itertools.count()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0}
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _shed(self, kind):
+        self.stats["shed"] += 1
+        metrics.admission_shed.inc(kind=kind)
+
+    @asynccontextmanager
+    async def slot(self, priority, kind):
+        """Hold a slot for the duration of the block; raises AdmissionRejected if shed."""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+        else:
+            await self._wait(priority, kind)
+        self.stats["admitted"] += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _wait(self, priority, kind):
+        if len(self._waiters) >= self.queue_size:
+            worst = max(self._waiters)
+            if worst[0] <= priority:
+                self._shed(kind)
+                raise AdmissionRejected()
+            # Make room by shedding the newest of the lowest-priority waiters.
+            self._waiters.remove(worst)
+            heapq.heapify(self._waiters)
+            worst[2].set_exception(AdmissionRejected())
+            self._shed(worst[3])
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future, kind]
+        heapq.heappush(self._waiters, entry)
+        self.stats["queued"] += 1
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just as we were cancelled.
+                self._release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+        finally:
+            metrics.observe_stage("admission_wait", time.perf_counter() - started)
+
+    def _release(self):
+        # Hand the slot straight to the best waiter so it can't be overtaken.
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def snapshot(self):
+        return dict(self.stats, active=self.active, waiting=len(self._waiters))
@@ -0,0 +1,604 @@
+"""
+Offline load test for the Whispr DM -> post path.
+
+Drives the real handlers in bot.py (`setup`, `on_message`, and the
+GuildPickButton / GuildPickSelect server picker callbacks, resolved from
+their custom ids as DynamicItems) against an in-process fake of the Discord
+REST/gateway layer with configurable latency. No token or network access is
+needed.
+
+   python bench.py --guilds 20 --users 500 --confessions 300 --replies 150 --concurrency 25 --latency 40
+
+Reports p50/p90/p99 end-to-end latency per phase, REST calls per operation
+broken down by route, and how long the event loop was blocked. Pass --json
+for machine-readable output and --max-p99 MS to exit non-zero on a
+regression.
+
+--lean runs the bot in lean-memory mode, --memory traces the bot's
+allocations with tracemalloc, and --compare-memory runs both modes in child
+processes and prints them side by side. --background-members adds members
+that never DM to every guild, which is what fills discord.py's member cache:
+
+   python bench.py --compare-memory --guilds 50 --background-members 5000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import itertools
+from collections import Counter
+
+import discord
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeResponse:
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+class FakeREST:
+    """Stands in for Discord's HTTP API: every call sleeps and is counted."""
+    def __init__(self, latency, jitter, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng
+        self.calls = Counter()
+        self._ids = itertools.count(10 ** 17)
+
+    def next_id(self):
+        return next(self._ids)
+
+    async def call(self, route):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+
+class FakeUser:
+    def __init__(self, rest, user_id, name, is_bot=False):
+        self.rest = rest
+        self.id = user_id
+        self.name = name
+        self.bot = is_bot
+        self.dm_channel = FakeDMChannel(rest, self)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    async def create_dm(self):
+        await self.rest.call("create_dm")
+        return self.dm_channel
+
+    async def send(self, content=None, **kwargs):
+        return await self.dm_channel.send(content, **kwargs)
+
+
+class FakeMember(FakeUser):
+    def __init__(self, user, guild):
+        self.__dict__.update(user.__dict__)
+        self.guild = guild
+
+
+class FakeDMChannel(discord.DMChannel):
+    # Subclassed so the isinstance check in on_message takes the DM branch.
+    def __init__(self, rest, recipient):
+        self.rest = rest
+        self.id = rest.next_id()
+        self.recipients = [recipient]
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.call("dm_send")
+        message = FakeMessage(self.rest, self, None, content, kwargs.get("embed"))
+        message.view = kwargs.get("view")
+        self.sent.append(message)
+        return message
+
+
+class FakeMessage:
+    def __init__(self, rest, channel, author, content, embed=None):
+        self.rest = rest
+        self.id = rest.next_id()
+        self.channel = channel
+        self.author = author
+        self.content = content or ""
+        self.embeds = [embed] if embed else []
+        self.guild = getattr(channel, "guild", None)
+        self.view = None
+        self._state = BOT.bot._connection
+
+    async def add_reaction(self, emoji):
+        await self.rest.call("add_reaction")
+
+
+class FakeTextChannel:
+    def __init__(self, rest, guild, name):
+        self.rest = rest
+        self.id = rest.next_id()
+        self.guild = guild
+        self.name = name
+        self.messages = []
+        self.by_id = {}
+
+    @property
+    def mention(self):
+        return f"<#{self.id}>"
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def send(self, content=None, embed=None, reference=None, **kwargs):
+        await self.rest.call("channel_send")
+        message = FakeMessage(self.rest, self, BOT.bot.user, content, embed)
+        self.messages.append(message)
+        self.by_id[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.rest.call("fetch_message")
+        message = self.by_id.get(message_id)
+        if message is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        return message
+
+    async def history(self, limit=100):
+        await self.rest.call("history")
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+
+class FakeGuild:
+    """A guild as Discord sees it, plus the bot's member cache for it.
+
+    Membership lives in _users (members who take part in the benchmark) and
+    the background range (members who never DM), which costs no memory.
+    chunk() fills _members with real discord.Member objects, so the member
+    cache weighs what it would with discord.py.
+    """
+    def __init__(self, rest, guild_id, name, bot_user, background=range(0)):
+        self.rest = rest
+        self.id = guild_id
+        self.name = name
+        self.chunked = False
+        self.unavailable = False
+        self._users = {}
+        self.background = background
+        self._members = {}
+        self.me = FakeMember(bot_user, self)
+        self.confession_channel = FakeTextChannel(rest, self, "confessions")
+        self.text_channels = [self.confession_channel]
+        self.system_channel = self.confession_channel
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def add_member(self, user):
+        self._users[user.id] = user
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        await self.rest.call("fetch_member")
+        user = self._users.get(user_id)
+        if user is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Member")
+        return FakeMember(user, self)
+
+    async def query_members(self, user_ids, limit=5, cache=True):
+        await self.rest.call("gateway_query_members")
+        return [FakeMember(self._users[user_id], self) for user_id in user_ids[:limit] if user_id in self._users]
+
+    async def chunk(self):
+        state = BOT.bot._connection
+        users = [(user.id, user.name) for user in self._users.values()]
+        users += [(user_id, f"member{user_id}") for user_id in self.background]
+        for user_id, name in users:
+            data = {
+                "user": {"id": str(user_id), "username": name, "discriminator": "0", "avatar": None, "global_name": None},
+                "roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0,
+            }
+            self._members[user_id] = discord.Member(data=data, guild=self, state=state)
+        self.chunked = True
+        return self.members
+
+
+class FakeInteractionResponse:
+    def __init__(self, rest):
+        self.rest = rest
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        await self.rest.call("interaction_response")
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        await self.rest.call("interaction_response")
+        self._done = True
+
+    async def edit_message(self, **kwargs):
+        await self.rest.call("interaction_response")
+        self._done = True
+
+
+class FakeInteraction:
+    def __init__(self, rest, user, message):
+        self.rest = rest
+        self.user = user
+        self.message = message
+        self.channel = user.dm_channel
+        self.response = FakeInteractionResponse(rest)
+
+    async def edit_original_response(self, **kwargs):
+        await self.rest.call("edit_original_response")
+
+
+class FakeContext:
+    def __init__(self, rest, guild, author):
+        self.rest = rest
+        self.guild = guild
+        self.author = author
+        self.channel = guild.confession_channel
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.call("channel_send")
+        self.sent.append(content)
+
+
+class LoopMonitor:
+    """Measures how long the event loop was unable to run a short sleep."""
+    def __init__(self, interval=0.005, threshold=0.002):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = 0.0
+        self.max_stall = 0.0
+        self.stalls = 0
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            if lag > self.threshold:
+                self.blocked += lag
+                self.stalls += 1
+                self.max_stall = max(self.max_stall, lag)
+
+    def reset(self):
+        self.blocked = 0.0
+        self.max_stall = 0.0
+        self.stalls = 0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rest = FakeREST(args.latency / 1000, args.jitter, self.rng)
+        self.monitor = LoopMonitor()
+        self.bot_user = FakeUser(self.rest, 1, "Whispr", is_bot=True)
+        self.guilds = {}
+        self.channels = {}
+        self.users = {}
+        self.user_guilds = {}
+        self.memory = None
+
+    def install(self):
+        bot = BOT.bot
+        bot._connection.user = self.bot_user
+        bot.get_guild = self.guilds.get
+        bot.get_channel = self.channels.get
+        bot.get_user = self.users.get
+
+        async def fetch_user(user_id):
+            await self.rest.call("fetch_user")
+            return self.users[user_id]
+        bot.fetch_user = fetch_user
+
+    def build_world(self):
+        per_guild = self.args.background_members
+        for i in range(self.args.guilds):
+            background = range(10 ** 9 + i * per_guild, 10 ** 9 + (i + 1) * per_guild)
+            guild = FakeGuild(self.rest, 1000 + i, f"Server {i}", self.bot_user, background)
+            self.guilds[guild.id] = guild
+            self.channels[guild.confession_channel.id] = guild.confession_channel
+        guild_ids = list(self.guilds)
+        for i in range(self.args.users):
+            user = FakeUser(self.rest, 10 ** 6 + i, f"user{i}")
+            self.users[user.id] = user
+            # Most users share one configured server with the bot, some several.
+            count = min(len(guild_ids), self.rng.choices([1, 2, 3, 7], weights=[60, 25, 10, 5])[0])
+            self.user_guilds[user.id] = self.rng.sample(guild_ids, count)
+            for guild_id in self.user_guilds[user.id]:
+                self.guilds[guild_id].add_member(user)
+
+    async def dm(self, user, content, target_guild_id):
+        """Send a DM through on_message and click through any server picker."""
+        message = FakeMessage(self.rest, user.dm_channel, user, content)
+        before = len(user.dm_channel.sent)
+        await BOT.on_message(message)
+        for reply in user.dm_channel.sent[before:]:
+            view = reply.view
+            if view is None:
+                continue
+            # Picker components are DynamicItems wrapping a Button or Select.
+            target = self.guilds[target_guild_id]
+            for item in view.children:
+                component = item.item
+                if isinstance(component, discord.ui.Select):
+                    values = [option.value for option in component.options]
+                    if str(target.id) in values:
+                        component._values = [str(target.id)]
+                        await item.callback(FakeInteraction(self.rest, user, reply))
+                        break
+                elif getattr(component, "label", None) == target.name:
+                    await item.callback(FakeInteraction(self.rest, user, reply))
+                    break
+            else:
+                await view.children[0].callback(FakeInteraction(self.rest, user, reply))
+
+    async def run_phase(self, name, operations):
+        latencies = []
+        errors = 0
+        calls_before = self.rest.calls.copy()
+        self.monitor.reset()
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run(op):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await op()
+                except Exception as e:
+                    errors += 1
+                    if self.args.verbose:
+                        print(f"{name} failed: {e!r}")
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run(op) for op in operations))
+        elapsed = time.perf_counter() - started
+
+        routes = self.rest.calls - calls_before
+        count = len(operations) or 1
+        return {
+            "phase": name,
+            "operations": len(operations),
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(max(latencies, default=0) * 1000, 2),
+            "rest_calls_per_op": round(sum(routes.values()) / count, 2),
+            "rest_calls_by_route": {route: round(n / count, 2) for route, n in sorted(routes.items())},
+            "loop_blocked_ms": round(self.monitor.blocked * 1000, 2),
+            "loop_max_stall_ms": round(self.monitor.max_stall * 1000, 2),
+        }
+
+    async def run(self):
+        self.build_world()
+        self.install()
+        if self.args.memory:
+            # The fake world is Discord's side; only what the bot allocates from here on counts.
+            tracemalloc.start()
+        monitor_task = asyncio.create_task(self.monitor.run())
+        await BOT.bot.setup_hook()
+        if not self.args.lean:
+            # discord.py chunks every guild before on_ready (chunk_guilds_at_startup).
+            for guild in self.guilds.values():
+                await guild.chunk()
+        await BOT.on_ready()
+        results = []
+
+        setup_command = BOT.bot.get_command("setup")
+
+        def setup_op(guild):
+            async def op():
+                admin = FakeMember(self.bot_user, guild)
+                await setup_command.callback(FakeContext(self.rest, guild, admin), guild.confession_channel)
+                if self.args.unlimited:
+                    for kind in ("confessions", "replies"):
+                        BOT.state.set_guild_setting(guild.id, f"rate_limit_{kind}", [10 ** 9, 1])
+            return op
+        results.append(await self.run_phase("setup", [setup_op(guild) for guild in self.guilds.values()]))
+
+        users = list(self.users.values())
+
+        def confession_op(i):
+            user = self.rng.choice(users)
+            target = self.rng.choice(self.user_guilds[user.id])
+
+            async def op():
+                await self.dm(user, f"benchmark confession {i} from {user.name}", target)
+            return op
+        results.append(await self.run_phase(
+            "confession", [confession_op(i) for i in range(self.args.confessions)]
+        ))
+
+        posted = list(BOT.state.confessions)
+        members_by_guild = {guild_id: list(guild._users) for guild_id, guild in self.guilds.items()}
+
+        def reply_op(i):
+            guild_id, code = self.rng.choice(posted)
+            user = self.users[self.rng.choice(members_by_guild[guild_id])]
+
+            async def op():
+                await self.dm(user, f"reply #{code:03d} benchmark reply {i}", guild_id)
+            return op
+        if posted and self.args.replies:
+            results.append(await self.run_phase("reply", [reply_op(i) for i in range(self.args.replies)]))
+
+        if self.args.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.memory = {
+                "mode": "lean" if self.args.lean else "members",
+                "traced_mb": round(current / 2 ** 20, 1),
+                "traced_peak_mb": round(peak / 2 ** 20, 1),
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "cached_members": sum(len(guild._members) for guild in self.guilds.values()),
+                "cached_users": len(BOT.bot._connection._users),
+                "member_lookups": BOT.member_lookup.snapshot(),
+            }
+
+        monitor_task.cancel()
+        await BOT.bot.close()
+        return results
+
+
+def print_report(args, results):
+    print(f"Whispr benchmark: {args.guilds} guilds, {args.users} users, "
+          f"concurrency {args.concurrency}, REST latency {args.latency} ms ±{args.jitter:.0%}")
+    for r in results:
+        print(f"\n[{r['phase']}] {r['operations']} ops in {r['elapsed_s']} s, {r['errors']} errors")
+        print(f"  latency  p50 {r['p50_ms']} ms  p90 {r['p90_ms']} ms  p99 {r['p99_ms']} ms  max {r['max_ms']} ms")
+        routes = ", ".join(f"{route} {n}" for route, n in r["rest_calls_by_route"].items())
+        print(f"  REST/op  {r['rest_calls_per_op']}  ({routes})")
+        print(f"  event loop blocked {r['loop_blocked_ms']} ms total, longest stall {r['loop_max_stall_ms']} ms")
+
+
+def print_memory(memory):
+    print(f"\n[memory] {memory['mode']} mode")
+    print(f"  traced {memory['traced_mb']} MB (peak {memory['traced_peak_mb']} MB), max RSS {memory['max_rss_mb']} MB")
+    print(f"  cached members {memory['cached_members']}, cached users {memory['cached_users']}")
+    lookups = memory["member_lookups"]
+    print(f"  member lookups: {lookups['hits']} cached, {lookups['misses']} asked, "
+          f"{lookups['queries']} gateway queries, {lookups['rest_lookups']} over REST, {lookups['cached']} answers cached")
+
+
+def compare_memory(args):
+    """Run the benchmark with and without lean-memory mode and compare them."""
+    argv = [arg for arg in sys.argv[1:] if arg not in ("--compare-memory", "--lean", "--json")]
+    runs = {}
+    for mode, extra in (("members", []), ("lean", ["--lean"])):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *argv, *extra, "--memory", "--json"],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        # The bot logs to stdout too; the report is the last top-level JSON object.
+        output = "\n" + output
+        runs[mode] = json.loads(output[output.rindex("\n{\n"):])
+    if args.json:
+        print(json.dumps(runs, indent=2))
+        return runs
+
+    print(f"Whispr memory: {args.guilds} guilds, {args.users} active users, "
+          f"{args.background_members} background members per guild, REST latency {args.latency} ms")
+    rows = [
+        ("traced MB", lambda run: run["memory"]["traced_mb"]),
+        ("traced peak MB", lambda run: run["memory"]["traced_peak_mb"]),
+        ("max RSS MB", lambda run: run["memory"]["max_rss_mb"]),
+        ("cached members", lambda run: run["memory"]["cached_members"]),
+        ("gateway queries", lambda run: run["memory"]["member_lookups"]["queries"]),
+        ("REST member lookups", lambda run: run["memory"]["member_lookups"]["rest_lookups"]),
+    ]
+    for phase in [result["phase"] for result in runs["members"]["phases"]]:
+        by_phase = lambda run, phase=phase: next(r for r in run["phases"] if r["phase"] == phase)
+        rows.append((f"{phase} p50 ms", lambda run, by_phase=by_phase: by_phase(run)["p50_ms"]))
+        rows.append((f"{phase} p99 ms", lambda run, by_phase=by_phase: by_phase(run)["p99_ms"]))
+    print(f"\n  {'':<20}{'members intent':>16}{'lean':>12}")
+    for label, value in rows:
+        print(f"  {label:<20}{value(runs['members']):>16}{value(runs['lean']):>12}")
+    return runs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline Whispr load test")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--confessions", type=int, default=200)
+    parser.add_argument("--replies", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20, help="operations in flight at once")
+    parser.add_argument("--latency", type=float, default=40, help="simulated REST latency in ms")
+    parser.add_argument("--jitter", type=float, default=0.25, help="latency jitter as a fraction")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--paced", action="store_true",
+                        help="keep the real per-channel send pacing (5 per 5s) instead of disabling it")
+    parser.add_argument("--limited", dest="unlimited", action="store_false",
+                        help="keep the default per-user rate limits")
+    parser.add_argument("--background-members", type=int, default=0,
+                        help="members per guild who never DM (they fill the member cache)")
+    parser.add_argument("--lean", action="store_true", help="run the bot in lean-memory mode")
+    parser.add_argument("--memory", action="store_true", help="trace the bot's memory with tracemalloc")
+    parser.add_argument("--compare-memory", action="store_true",
+                        help="run with and without --lean in child processes and compare memory")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--max-p99", type=float, help="exit 1 if any phase's p99 exceeds this many ms")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def import_bot(workdir, args):
+    # Keep the benchmark's database and any legacy JSON out of the repo.
+    os.chdir(workdir)
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["DATABASE_FILE"] = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("STATE_FLUSH_INTERVAL", "0.5")
+    os.environ.setdefault("NOTIFY_COALESCE_WINDOW", "1")
+    os.environ.pop("RATE_LIMIT_SNAPSHOT", None)
+    if args.lean:
+        os.environ["LEAN_MEMORY"] = "1"
+    if not args.paced:
+        os.environ["CHANNEL_SEND_RATE"] = "1000000"
+        os.environ["REACTION_INTERVAL"] = "0"
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    return bot
+
+
+def main():
+    global BOT
+    args = parse_args()
+    if args.compare_memory:
+        compare_memory(args)
+        return
+    with tempfile.TemporaryDirectory() as workdir:
+        BOT = import_bot(workdir, args)
+        simulation = Simulation(args)
+        results = asyncio.run(simulation.run())
+        os.chdir(REPO_DIR)
+
+    if args.json:
+        output = results if simulation.memory is None else {"phases": results, "memory": simulation.memory}
+        print(json.dumps(output, indent=2))
+    else:
+        print_report(args, results)
+        if simulation.memory is not None:
+            print_memory(simulation.memory)
+
+    if args.max_p99 is not None and any(r["p99_ms"] > args.max_p99 for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ Setup Instructions:
 
 2. Create a .env file in this directory with:
    TOKEN=your_discord_bot_token
+   # optional: STORAGE_BACKEND=sqlite|json, DATABASE_FILE=whispr.db
 
 3. Run the bot:
    python bot.py
@@ -19,263 +20,833 @@ The bot allows users to send anonymous confessions and replies via DM.
 """
 
 import os
+import asyncio
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import time
-import json
-
-CONFESSION_RATE_LIMIT = 30
-COUNTER_FILE = "confession_counter.txt"
-CONFESSION_MAP_FILE = "confession_map.json"
-CONFESSION_GUILD_MAP_FILE = "confession_guild_map.json"
-CONFESSION_COUNTERS_FILE = "confession_counters.json"
-
-user_last_confession = {}
-
-def load_guild_map():
-    if not os.path.exists(CONFESSION_GUILD_MAP_FILE):
-        return {}
-    with open(CONFESSION_GUILD_MAP_FILE, "r") as f:
-        return json.load(f)
-
-def save_guild_map(guild_map):
-    with open(CONFESSION_GUILD_MAP_FILE, "w") as f:
-        json.dump(guild_map, f)
-
-def load_confession_counters():
-    if not os.path.exists(CONFESSION_COUNTERS_FILE):
-        return {}
-    with open(CONFESSION_COUNTERS_FILE, "r") as f:
-        return json.load(f)
-
-def save_confession_counters(counters):
-    with open(CONFESSION_COUNTERS_FILE, "w") as f:
-        json.dump(counters, f)
-
-def get_next_confession_code(guild_id):
-    counters = load_confession_counters()
-    gid = str(guild_id)
-    num = counters.get(gid, 1)
-    counters[gid] = num + 1
-    save_confession_counters(counters)
-    return num
-
-def load_confession_map():
-    if not os.path.exists(CONFESSION_MAP_FILE):
-        return {}
-    with open(CONFESSION_MAP_FILE, "r") as f:
-        return json.load(f)
-
-def save_confession_map(confession_map):
-    with open(CONFESSION_MAP_FILE, "w") as f:
-        json.dump(confession_map, f)
-
-confession_map = load_confession_map()
-guild_map = load_guild_map()
+import tempfile
+import aiohttp
+from storage import open_storage
+from state import BotState
+from delivery import SendPipeline, ReplyNotifier, TTLCache
+from ratelimit import RateLimiter, DEFAULT_POLICIES, save_snapshot, load_snapshot
+import metrics
+from admission import (
+    AdmissionController, AdmissionRejected, PRIORITY_COMMAND, PRIORITY_REPLY, PRIORITY_CONFESSION
+)
+from membership import MemberLookup
+from transfer import ExportWriter, ImportReader, TransferError, EXPORT_PART_SIZE
+from moderation import (
+    DuplicateFilter, DEFAULT_DUPLICATE_POLICY, DUPLICATE_ACTIONS, MAX_DISTANCE,
+    ContentFilter, FILTER_ACTIONS, MAX_FILTER_WORDS, MAX_FILTER_PATTERNS, normalize_word, validate_pattern,
+)
 
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
-if not TOKEN:
-    raise RuntimeError("Missing TOKEN in .env file.")
+
+# Sharding: SHARD_COUNT > 0 runs an AutoShardedBot, optionally limited to
+# SHARD_IDS. cluster.py sets CLUSTER_MODE=1 when it runs several of these
+# processes against one shared SQLite database.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()]
+CLUSTER_MODE = os.getenv("CLUSTER_MODE") == "1"
+# Discord delivers DMs on shard 0 only, so only the process serving it
+# handles confessions and replies.
+HANDLES_DMS = not SHARD_IDS or 0 in SHARD_IDS
+
+# Lean memory mode: no privileged members intent, no member cache or chunking
+# and a small message cache. DM routing asks Discord whether the author is in
+# each configured guild instead, through membership.MemberLookup.
+LEAN_MEMORY = os.getenv("LEAN_MEMORY") == "1"
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "100" if LEAN_MEMORY else "1000"))
+
+# Importing this module does no I/O: storage is opened and the state
+# snapshot loaded once, in setup_hook, when the bot actually starts.
+state = BotState(shared=CLUSTER_MODE)
+send_pipeline = SendPipeline()
+admission = AdmissionController()
+
+def load_state():
+    storage = open_storage()
+    if CLUSTER_MODE and not hasattr(storage, "load_guild_directory"):
+        storage.close()
+        raise RuntimeError("Cluster mode requires STORAGE_BACKEND=sqlite.")
+    state.load(storage)
+
+# Optional file the rate limiter is snapshotted to, so a restart during a
+# raid doesn't hand every user a fresh allowance. Only the process that
+# handles DMs rate-limits anyone, so in a cluster only it keeps the file.
+RATE_LIMIT_SNAPSHOT = os.getenv("RATE_LIMIT_SNAPSHOT") if HANDLES_DMS else None
+RATE_LIMIT_SNAPSHOT_INTERVAL = 30
+rate_limiter = RateLimiter()
+
+def get_rate_limit_policy(guild_id, kind):
+    limit, per = state.get_guild_setting(guild_id, f"rate_limit_{kind}", DEFAULT_POLICIES[kind])
+    return limit, per
+
+def check_rate_limit(user_id, guild_id, kind):
+    limit, per = get_rate_limit_policy(guild_id, kind)
+    allowed, _ = rate_limiter.hit((kind, user_id, guild_id), limit, per)
+    if not allowed:
+        metrics.user_rate_limits.inc(kind=kind)
+    return allowed
+
+duplicate_filter = DuplicateFilter()
+content_filter = ContentFilter()
+
+def get_duplicate_policy(guild_id):
+    return dict(DEFAULT_DUPLICATE_POLICY, **state.get_guild_setting(guild_id, "duplicates", {}))
+
+def get_filter_rules(guild_id):
+    rules = state.get_guild_setting(guild_id, "filter", None) or {"version": 0, "words": {}, "patterns": {}}
+    return {"version": rules["version"], "words": dict(rules["words"]), "patterns": dict(rules["patterns"])}
+
+def save_filter_rules(guild_id, rules):
+    # A new version makes the content filter recompile this guild's rules on the next message.
+    rules["version"] += 1
+    state.set_guild_setting(guild_id, "filter", rules)
+
+async def screen_content(guild_id, content):
+    """Run a confession or reply through the guild's content filter; returns (action, content)."""
+    with metrics.timer("content_filter"):
+        action, content = await content_filter.check(guild_id, content, state.get_guild_setting(guild_id, "filter", None))
+    if action != "allow":
+        metrics.content_filtered.inc(action=action)
+    return action, content
+
+RATE_LIMIT_SINGULAR = {"confessions": "confession", "replies": "reply"}
+
+def describe_rate_limit(guild_id, kind):
+    limit, per = get_rate_limit_policy(guild_id, kind)
+    noun = kind if limit != 1 else RATE_LIMIT_SINGULAR[kind]
+    return f"{limit} {noun} every {per} seconds"
+
+async def snapshot_rate_limits():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SNAPSHOT_INTERVAL)
+        try:
+            await loop.run_in_executor(None, save_snapshot, rate_limiter.snapshot(), RATE_LIMIT_SNAPSHOT)
+        except OSError as e:
+            print(f"Rate limit snapshot failed: {e}")
 
 intents = discord.Intents.default()
 intents.messages = True
 intents.dm_messages = True
 intents.guilds = True
 intents.message_content = True
-intents.members = True  
+intents.members = not LEAN_MEMORY
+
+# Permissions the bot needs in a confession channel, as shown to admins.
+CONFESSION_PERMISSIONS = (
+    ("send_messages", "Send Messages"),
+    ("embed_links", "Embed Links"),
+    ("add_reactions", "Add Reactions"),
+)
+
+# Without these a confession can't be posted at all; reactions are optional.
+POSTING_PERMISSIONS = {"Send Messages", "Embed Links"}
+
+def check_channel_permissions(channel):
+    """Return the names of the permissions the bot is missing in a confession channel."""
+    permissions = channel.permissions_for(channel.guild.me)
+    return [label for name, label in CONFESSION_PERMISSIONS if not getattr(permissions, name)]
+
+class ChannelHealth:
+    """A guild's resolved confession channel and the permissions the bot lacks in it."""
+    def __init__(self, channel_id, channel, missing):
+        self.channel_id = channel_id
+        self.channel = channel
+        self.missing = missing
 
-bot = commands.Bot(
+    @property
+    def can_post(self):
+        return self.channel is not None and not POSTING_PERMISSIONS.intersection(self.missing)
+
+    @property
+    def problem(self):
+        if self.channel is None:
+            return "the confession channel no longer exists"
+        if self.missing:
+            return f"I'm missing {', '.join(self.missing)} in {self.channel.mention}"
+        return None
+
+class WhisprBot(commands.AutoShardedBot if SHARD_COUNT else commands.Bot):
+    started_at = None
+
+    async def setup_hook(self):
+        self.started_at = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, load_state)
+        print(
+            f"Loaded {len(state.guild_map)} confession channels and {len(state.confessions)} recent confessions "
+            f"in {time.perf_counter() - self.started_at:.2f}s"
+        )
+        state.start()
+        self.add_dynamic_items(GuildPickButton, GuildPickSelect, GuildPageButton)
+        if RATE_LIMIT_SNAPSHOT:
+            rate_limiter.restore(load_snapshot(RATE_LIMIT_SNAPSHOT))
+            self.rate_limit_snapshot_task = asyncio.create_task(snapshot_rate_limits())
+        metrics.instrument_http(self.http)
+        metrics.install_rate_limit_counter()
+        self.metrics_runner = None
+        if metrics.METRICS_PORT:
+            self.metrics_runner = await metrics.start_http_server()
+
+    async def close(self):
+        await super().close()
+        await send_pipeline.close()
+        await reply_notifier.close()
+        await member_lookup.close()
+        await content_filter.close()
+        if getattr(self, "metrics_runner", None):
+            await self.metrics_runner.cleanup()
+        # Without setup_hook the limiter was never restored; saving it would
+        # overwrite the snapshot with nothing.
+        if getattr(self, "rate_limit_snapshot_task", None):
+            self.rate_limit_snapshot_task.cancel()
+            save_snapshot(rate_limiter.snapshot(), RATE_LIMIT_SNAPSHOT)
+        # Final flush of anything the write-behind task hasn't persisted yet.
+        await state.close()
+
+shard_options = {}
+if SHARD_COUNT:
+    shard_options["shard_count"] = SHARD_COUNT
+    if SHARD_IDS:
+        shard_options["shard_ids"] = SHARD_IDS
+
+bot = WhisprBot(
     command_prefix='!', 
     intents=intents,
     reconnect=True,
-    max_messages=1000  
+    max_messages=MESSAGE_CACHE_SIZE or None,
+    member_cache_flags=discord.MemberCacheFlags.none() if LEAN_MEMORY else discord.MemberCacheFlags.from_intents(intents),
+    chunk_guilds_at_startup=not LEAN_MEMORY,
+    **shard_options
 )
+reply_notifier = ReplyNotifier(bot)
+member_lookup = MemberLookup(bot)
 
-class ServerSelectView(discord.ui.View):
-    def __init__(self, confession_channels, user_message):
-        super().__init__(timeout=60)
-        self.confession_channels = confession_channels
-        self.user_message = user_message
-        
-        for i, channel in enumerate(confession_channels[:5]):  
-            button = discord.ui.Button(
-                label=channel.guild.name[:80],  
-                style=discord.ButtonStyle.primary,
-                custom_id=f"server_{i}"
-            )
-            button.callback = self.create_callback(i)
-            self.add_item(button)
-    
-    def create_callback(self, index):
-        async def callback(interaction):
-            if interaction.user.id != self.user_message.author.id:
-                await interaction.response.send_message("❌ This is not your server selection.", ephemeral=True)
-                return
-            
-            confession_channel = self.confession_channels[index]
-            await interaction.response.defer()
-            
-            await self.process_confession(confession_channel, self.user_message)
-            
-            # The process_confession method already sends a confirmation message
-            # Just edit the button message to show success
-            embed = discord.Embed(
-                title="✅ Server Selected!",
-                description=f"Confession posted successfully!",
-                color=0x00ff00
-            )
-            await interaction.edit_original_response(embed=embed, view=None)
-        
-        return callback
-    
-    async def process_confession(self, confession_channel, user_message):
-        guild_id = confession_channel.guild.id
-        key = (user_message.author.id, guild_id)
-        now = time.time()
-        last = user_last_confession.get(key, 0)
-        if now - last < CONFESSION_RATE_LIMIT:
-            await user_message.channel.send("⏳ Please wait before sending another confession in this server.")
-            return
-        user_last_confession[key] = now
+metrics.registry.gauge(
+    "whispr_send_queue_depth", "Messages waiting in the per-channel send queues.",
+    lambda: sum(send_pipeline.snapshot()["queue_depth"].values()),
+)
+metrics.registry.gauge(
+    "whispr_pending_reactions", "Confessions whose reactions haven't been added yet.",
+    lambda: send_pipeline.pending_reactions,
+)
+metrics.registry.gauge(
+    "whispr_admission_active", "DMs and commands currently being handled.", lambda: admission.active
+)
+metrics.registry.gauge(
+    "whispr_admission_queued", "DMs and commands waiting for an admission slot.", lambda: admission.queued
+)
+metrics.registry.gauge(
+    "whispr_state_dirty", "Changes waiting for the next write-behind flush.", lambda: state.dirty_count
+)
+metrics.registry.gauge(
+    "whispr_member_cache_entries", "Membership answers cached by lean-memory mode.", lambda: len(member_lookup)
+)
+metrics.registry.gauge(
+    "whispr_rate_limit_buckets", "Users currently tracked by the rate limiter.", lambda: len(rate_limiter)
+)
 
-        content = user_message.content.strip()
-        if not content:
-            await user_message.channel.send("❌ Your confession cannot be empty.")
-            return
-        
-        code = get_next_confession_code(guild_id)
-        
-        embed = discord.Embed(
-            title=f"💬 Anonymous Confession #{code:03d}",
-            description=content,
-            color=0x3498db,
-            timestamp=discord.utils.utcnow()
+# user id -> ids of configured guilds the user is a member of. Built from the
+# gateway member cache so DM routing doesn't need a fetch_member per guild.
+member_guild_index = {}
+# configured guilds whose full member list is reflected in member_guild_index
+indexed_guilds = set()
+# (guild_id, user_id) pairs the REST fallback found not to be members, kept
+# briefly so someone outside an unindexed guild doesn't cost a fetch on every DM.
+NON_MEMBER_CACHE_SIZE = int(os.getenv("NON_MEMBER_CACHE_SIZE", "10000"))
+NON_MEMBER_TTL = float(os.getenv("NON_MEMBER_TTL", "60"))
+non_member_cache = TTLCache(NON_MEMBER_CACHE_SIZE, NON_MEMBER_TTL)
+
+def add_guild_members(guild, index):
+    """Add a chunked guild's members to an index and publish them; returns their ids."""
+    member_ids = [member.id for member in guild.members if not member.bot]
+    for member_id in member_ids:
+        index.setdefault(member_id, set()).add(guild.id)
+    state.publish_guild_members(guild.id, guild.name, member_ids)
+    return member_ids
+
+def index_guild_members(guild):
+    if LEAN_MEMORY or not guild.chunked:
+        return False
+    add_guild_members(guild, member_guild_index)
+    indexed_guilds.add(guild.id)
+    return True
+
+def unindex_guild(guild_id):
+    if guild_id in indexed_guilds:
+        state.publish_guild_members(guild_id, None, [])
+    indexed_guilds.discard(guild_id)
+    for user_id in list(member_guild_index):
+        guild_ids = member_guild_index[user_id]
+        guild_ids.discard(guild_id)
+        if not guild_ids:
+            del member_guild_index[user_id]
+
+def unindex_member(user_id, guild_id):
+    if guild_id in indexed_guilds:
+        state.publish_member(guild_id, user_id, False)
+    guild_ids = member_guild_index.get(user_id)
+    if guild_ids is None:
+        return
+    guild_ids.discard(guild_id)
+    if not guild_ids:
+        del member_guild_index[user_id]
+
+async def build_member_index(guild_map):
+    """Build the index from the member cache, on startup and after every full reconnect.
+
+    The new index is built on the side and swapped in at the end, so the
+    previous one keeps routing DMs while guilds are re-chunked instead of
+    every DM falling back to REST lookups in the meantime.
+    """
+    if LEAN_MEMORY:
+        return
+    guilds = [guild for guild in map(bot.get_guild, guild_map) if guild is not None and not guild.unavailable]
+    # Chunk requests are answered over the gateway, so they can all be in flight at once.
+    await asyncio.gather(*(guild.chunk() for guild in guilds if not guild.chunked))
+    index = {}
+    indexed = set()
+    for guild in guilds:
+        if guild.chunked:
+            add_guild_members(guild, index)
+            indexed.add(guild.id)
+    # Guilds that couldn't be chunked this time keep what was known about them.
+    kept = indexed_guilds - indexed
+    if kept:
+        for user_id, guild_ids in member_guild_index.items():
+            if not guild_ids.isdisjoint(kept):
+                index.setdefault(user_id, set()).update(guild_ids & kept)
+    # No await from here on, so DM routing never sees a half-swapped index.
+    member_guild_index.clear()
+    member_guild_index.update(index)
+    indexed_guilds.clear()
+    indexed_guilds.update(indexed | kept)
+
+# guild_id -> ChannelHealth for guilds served by this process. Entries are
+# dropped by the channel, role and guild events that can change them, so DM
+# routing and !status never recompute permissions on the hot path.
+channel_health = {}
+
+def get_channel_health(guild_id):
+    channel_id = state.guild_map.get(guild_id)
+    health = channel_health.get(guild_id)
+    # The channel id check catches !setup run in another cluster process.
+    if health is None or health.channel_id != channel_id:
+        channel = bot.get_channel(channel_id) if channel_id else None
+        missing = check_channel_permissions(channel) if channel is not None else []
+        health = channel_health[guild_id] = ChannelHealth(channel_id, channel, missing)
+    return health
+
+def find_announcement_channel(guild, exclude=None):
+    """Pick a channel the bot can talk to admins in: the system channel, else the first writable one."""
+    channel = guild.system_channel
+    if channel is not None and channel != exclude and channel.permissions_for(guild.me).send_messages:
+        return channel
+    for c in guild.text_channels:
+        if c != exclude and c.permissions_for(guild.me).send_messages:
+            return c
+    return None
+
+async def recheck_channel_health(guild):
+    """Drop the cached health of a guild's confession channel and warn admins if it just broke."""
+    if guild.id not in state.guild_map:
+        return
+    previous = channel_health.pop(guild.id, None)
+    health = get_channel_health(guild.id)
+    if health.problem is None or (previous is not None and previous.problem is not None):
+        return
+    channel = find_announcement_channel(guild, exclude=None if health.can_post else health.channel)
+    if channel is None:
+        print(f"Confession channel of server {guild.id} broke and no channel is available to report it: {health.problem}")
+        return
+    try:
+        await channel.send(
+            f"⚠️ **Whispr can't post confessions properly:** {health.problem}.\n"
+            "An admin can check with `!status` or choose a new channel with `!setup #channel`."
         )
-        embed.set_footer(text=f"Reply using: DM me 'reply #{code:03d} your message'")
-        
-        confession_msg = await confession_channel.send(embed=embed)
-        await confession_msg.add_reaction("👍")
-        await confession_msg.add_reaction("👎")
-        
-        confession_map = load_confession_map()
-        confession_map[str(code)] = user_message.author.id
-        save_confession_map(confession_map)
-        
-        await user_message.channel.send(f"✅ Your confession has been posted anonymously in **{confession_channel.guild.name}**!")
+    except discord.HTTPException as e:
+        print(f"Failed to report broken confession channel in server {guild.id}: {e}")
+
+def warm_confession_channels(guild_map):
+    """Resolve and permission-check the confession channel of every configured guild served here.
+
+    Returns {guild_id: problem} for the channels that won't accept confessions.
+    """
+    channel_health.clear()
+    problems = {}
+    for guild_id in guild_map:
+        if bot.get_guild(guild_id) is None:
+            continue
+        health = get_channel_health(guild_id)
+        if health.problem is not None:
+            problems[guild_id] = health.problem
+    return problems
+
+async def fetch_is_member(guild, user_id):
+    """True or False, or None when Discord couldn't say (treated as not a member, but not cached)."""
+    try:
+        await guild.fetch_member(user_id)
+        return True
+    except discord.NotFound:
+        return False
+    except discord.Forbidden:
+        return guild.get_member(user_id) is not None
+    except discord.HTTPException:
+        return None
+
+async def lookup_member_guilds(user_id, guild_map):
+    """Lean-memory version of get_member_guilds: ask Discord, through the membership cache."""
+    guilds = [guild for guild in map(bot.get_guild, guild_map) if guild is not None]
+    results = await asyncio.gather(*(member_lookup.is_member(guild.id, user_id) for guild in guilds))
+    return sorted((guild for guild, is_member in zip(guilds, results) if is_member), key=lambda guild: guild.id)
+
+async def lookup_remote_guild_ids(user_id, guild_map):
+    """Lean-memory version of state.fetch_member_guild_ids: nothing is published, so ask over REST."""
+    guild_ids = [guild_id for guild_id in guild_map if bot.get_guild(guild_id) is None]
+    results = await asyncio.gather(*(member_lookup.is_member(guild_id, user_id) for guild_id in guild_ids))
+    return [guild_id for guild_id, is_member in zip(guild_ids, results) if is_member]
+
+async def get_member_guilds(user_id, guild_map):
+    """Return the configured guilds the user is a member of."""
+    if LEAN_MEMORY:
+        return await lookup_member_guilds(user_id, guild_map)
+    guild_ids = member_guild_index.get(user_id, set())
+    guilds = []
+    for guild_id in guild_ids:
+        guild = bot.get_guild(guild_id)
+        if guild is not None and guild_id in guild_map:
+            guilds.append(guild)
+
+    missing = []
+    if len(indexed_guilds) < len(guild_map):
+        for gid in guild_map:
+            if gid in indexed_guilds or gid in guild_ids or non_member_cache.get((gid, user_id)):
+                continue
+            guild = bot.get_guild(gid)
+            if guild is not None:
+                missing.append(guild)
+
+    # Only guilds whose member list isn't indexed (not chunked yet, or
+    # unavailable when the index was built) fall back to REST.
+    if missing:
+        results = await asyncio.gather(*(fetch_is_member(guild, user_id) for guild in missing))
+        for guild, is_member in zip(missing, results):
+            if is_member:
+                member_guild_index.setdefault(user_id, set()).add(guild.id)
+                guilds.append(guild)
+            elif is_member is False:
+                non_member_cache.set((guild.id, user_id), True)
+
+    guilds.sort(key=lambda guild: guild.id)
+    return guilds
+
+class RemoteGuild:
+    def __init__(self, guild_id, name):
+        self.id = guild_id
+        self.name = name
+
+class RemoteChannel:
+    """Confession channel of a guild served by another cluster process.
+
+    Wraps a PartialMessageable, which can send, fetch and read history over
+    REST without the guild being in this process's cache.
+    """
+    def __init__(self, channel_id, guild_id, guild_name):
+        self._channel = bot.get_partial_messageable(channel_id, guild_id=guild_id, type=discord.ChannelType.text)
+        self.guild = RemoteGuild(guild_id, guild_name)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+async def get_confession_channels(user_id):
+    """Return the confession channels of every configured guild the user is in."""
+    guild_map = state.guild_map
+    with metrics.timer("membership"):
+        member_guilds = await get_member_guilds(user_id, guild_map)
+        if not state.shared:
+            remote_guild_ids = []
+        elif LEAN_MEMORY:
+            remote_guild_ids = await lookup_remote_guild_ids(user_id, guild_map)
+        else:
+            remote_guild_ids = await state.fetch_member_guild_ids(user_id)
+
+    with metrics.timer("guild_map"):
+        confession_channels = []
+        for guild in member_guilds:
+            health = get_channel_health(guild.id)
+            if health.can_post:
+                confession_channels.append(health.channel)
+
+        if state.shared:
+            # DMs only arrive on shard 0; guilds served by other processes are
+            # resolved through the membership they publish to the shared store.
+            for guild_id in remote_guild_ids:
+                if guild_id in guild_map and bot.get_guild(guild_id) is None:
+                    guild_name = state.guild_names.get(guild_id, f"Server {guild_id}")
+                    confession_channels.append(RemoteChannel(guild_map[guild_id], guild_id, guild_name))
+            confession_channels.sort(key=lambda channel: channel.guild.id)
+
+    return confession_channels
+
+async def process_confession(confession_channel, author_id, dm_channel, content):
+    """Screen and post a confession, telling the author how it went.
+
+    Returns the outcome: "posted", "held", "rejected" or "limited".
+    """
+    guild_id = confession_channel.guild.id
+    if not check_rate_limit(author_id, guild_id, "confessions"):
+        await dm_channel.send("⏳ Please wait before sending another confession in this server.")
+        return "limited"
+
+    content = content.strip()
+    if not content:
+        await dm_channel.send("❌ Your confession cannot be empty.")
+        return "rejected"
+
+    # Screening runs before a confession number is taken, so rejected
+    # messages and raid copies cost nothing.
+    action, content = await screen_content(guild_id, content)
+    if action == "reject":
+        await dm_channel.send("❌ Your confession contains something this server doesn't allow, so it wasn't posted.")
+        return "rejected"
+    if action == "hold":
+        await state.add_hold(guild_id, author_id, content, "content filter")
+        await dm_channel.send(f"🕒 Your confession to **{confession_channel.guild.name}** is being held for review by the server's admins.")
+        return "held"
+
+    with metrics.timer("duplicate_check"):
+        verdict, fingerprint = duplicate_filter.check(guild_id, content, get_duplicate_policy(guild_id))
+    if verdict == "reject":
+        await dm_channel.send("❌ This looks like a copy of a confession posted recently in this server, so it wasn't posted.")
+        return "rejected"
+    duplicate_filter.remember(guild_id, fingerprint)
+    if verdict == "hold":
+        await state.add_hold(guild_id, author_id, content, "near-duplicate")
+        await dm_channel.send(f"🕒 Your confession to **{confession_channel.guild.name}** is being held for review by the server's admins.")
+        return "held"
+
+    await post_confession(confession_channel, author_id, content)
+    await dm_channel.send(f"✅ Your confession has been posted anonymously in **{confession_channel.guild.name}**!")
+    return "posted"
+
+async def post_confession(confession_channel, author_id, content):
+    guild_id = confession_channel.guild.id
+    with metrics.timer("code_allocation"):
+        code = await state.allocate_confession_code(guild_id)
     
-    async def on_timeout(self):
-        for item in self.children:
-            item.disabled = True
-
-class ReplySelectView(discord.ui.View):
-    def __init__(self, confession_channels, user_message, code, reply_content):
-        super().__init__(timeout=60)
-        self.confession_channels = confession_channels
-        self.user_message = user_message
-        self.code = code
-        self.reply_content = reply_content
-        
-        for i, channel in enumerate(confession_channels[:5]):  
-            button = discord.ui.Button(
-                label=channel.guild.name[:80],
-                style=discord.ButtonStyle.secondary,
-                custom_id=f"reply_server_{i}"
-            )
-            button.callback = self.create_callback(i)
-            self.add_item(button)
+    # Create embed for confession to prevent @everyone pings
+    embed = discord.Embed(
+        title=f"💬 Anonymous Confession #{code:03d}",
+        description=content,
+        color=0x3498db,
+        timestamp=discord.utils.utcnow()
+    )
+    embed.set_footer(text=f"Reply using: DM me 'reply #{code:03d} your message'")
     
-    def create_callback(self, index):
-        async def callback(interaction):
-            if interaction.user.id != self.user_message.author.id:
-                await interaction.response.send_message("❌ This is not your reply selection.", ephemeral=True)
-                return
-            
-            confession_channel = self.confession_channels[index]
-            await interaction.response.defer()
-            
-            await self.process_reply(confession_channel, self.user_message, self.code, self.reply_content)
-            
-            embed = discord.Embed(
-                title="✅ Server Selected!",
-                description=f"Reply posted successfully!",
-                color=0x00ff00
-            )
-            await interaction.edit_original_response(embed=embed, view=None)
-        
-        return callback
+    confession_msg = await send_pipeline.send(confession_channel, embed=embed)
+    # Reactions are added in the background; the user is acknowledged as
+    # soon as the confession exists.
+    send_pipeline.add_reactions(confession_msg, ("👍", "👎"))
     
-    async def process_reply(self, confession_channel, user_message, code, reply_content):
-        confession_message = None
+    posted_at = time.time()
+    state.record_confession(guild_id, code, author_id, confession_channel.id, confession_msg.id, posted_at)
+    state.index_text(guild_id, "confession", code, content, confession_channel.id, confession_msg.id, posted_at)
+    return code
+
+async def find_confession_message(confession_channel, code, confession):
+    if confession and confession["message_id"]:
+        channel_id, message_id = confession["channel_id"], confession["message_id"]
+        if channel_id != confession_channel.id:
+            # Posted in a previous confession channel; replies can't reference it.
+            return None
+        cached = discord.utils.get(bot.cached_messages, id=message_id)
+        if cached:
+            return cached
+        try:
+            with metrics.timer("message_lookup"):
+                return await confession_channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+        except discord.HTTPException:
+            pass
+
+    # Confessions posted before the message index existed are only
+    # reachable through the recent channel history.
+    with metrics.timer("history_scan"):
         async for msg in confession_channel.history(limit=100):
             if (msg.author == bot.user and 
                 msg.embeds and 
                 msg.embeds[0].title and 
-                msg.embeds[0].title.startswith(f"💬 Anonymous Confession #{int(code):03d}")):
-                confession_message = msg
-                break
-        
-        if confession_message:
-            reply_embed = discord.Embed(
-                title=f"💬 Anonymous Reply to Confession #{int(code):03d}",
-                description=reply_content,
-                color=0xe74c3c,
-                timestamp=discord.utils.utcnow()
-            )
-            reply_embed.set_footer(text="This is an anonymous reply")
-            
-            await confession_channel.send(embed=reply_embed, reference=confession_message)
-            await user_message.channel.send(f"✅ Your anonymous reply to confession #{int(code):03d} has been posted in **{confession_channel.guild.name}**!")
-            
-            confession_map = load_confession_map()
-            user_id = confession_map.get(str(int(code)))
-            if user_id:
-                try:
-                    user = await bot.fetch_user(user_id)
-                    await user.send(
-                        f"📩 Your confession #{int(code):03d} received a new anonymous reply:\n{reply_content}"
-                    )
-                except Exception:
-                    pass
-        else:
-            reply_embed = discord.Embed(
-                title=f"💬 Anonymous Reply to Confession #{int(code):03d}",
-                description=reply_content,
-                color=0xe74c3c,
-                timestamp=discord.utils.utcnow()
-            )
-            reply_embed.set_footer(text="Original confession not found")
-            
-            await confession_channel.send(embed=reply_embed)
-            await user_message.channel.send(f"⚠️ Confession #{int(code):03d} not found in **{confession_channel.guild.name}**. Your reply was posted as a normal message.")
-    
-    async def on_timeout(self):
-        for item in self.children:
-            item.disabled = True
+                msg.embeds[0].title.startswith(f"💬 Anonymous Confession #{code:03d}")):
+                return msg
+    return None
+
+async def process_reply(confession_channel, author_id, dm_channel, code, reply_content):
+    """Screen and post a reply; returns the outcome like process_confession."""
+    guild_id = confession_channel.guild.id
+    if not check_rate_limit(author_id, guild_id, "replies"):
+        await dm_channel.send("⏳ Please wait before sending another reply in this server.")
+        return "limited"
+    code = int(code)
+
+    action, reply_content = await screen_content(guild_id, reply_content)
+    if action == "reject":
+        await dm_channel.send("❌ Your reply contains something this server doesn't allow, so it wasn't posted.")
+        return "rejected"
+    if action == "hold":
+        await state.add_hold(guild_id, author_id, reply_content, "content filter", kind="reply", code=code)
+        await dm_channel.send(
+            f"🕒 Your reply to confession #{code:03d} in **{confession_channel.guild.name}** is being held for review by the server's admins."
+        )
+        return "held"
+
+    if await post_reply(confession_channel, code, reply_content):
+        await dm_channel.send(f"✅ Your anonymous reply to confession #{code:03d} has been posted in **{confession_channel.guild.name}**!")
+    else:
+        await dm_channel.send(f"⚠️ Confession #{code:03d} not found in **{confession_channel.guild.name}**. Your reply was posted as a normal message.")
+    return "posted"
+
+async def post_reply(confession_channel, code, reply_content):
+    """Post an anonymous reply under its confession; returns False if the confession wasn't found."""
+    guild_id = confession_channel.guild.id
+    confession = await state.fetch_confession(guild_id, code)
+    confession_message = await find_confession_message(confession_channel, code, confession)
+
+    reply_embed = discord.Embed(
+        title=f"💬 Anonymous Reply to Confession #{code:03d}",
+        description=reply_content,
+        color=0xe74c3c,
+        timestamp=discord.utils.utcnow()
+    )
+    if confession_message:
+        reply_embed.set_footer(text="This is an anonymous reply")
+        reply_msg = await send_pipeline.send(confession_channel, embed=reply_embed, reference=confession_message)
+
+        user_id = confession and confession["author_id"]
+        if user_id:
+            reply_notifier.notify(user_id, code, reply_content)
+    else:
+        # The original confession is gone; post the reply as a normal message.
+        reply_embed.set_footer(text="Original confession not found")
+        reply_msg = await send_pipeline.send(confession_channel, embed=reply_embed)
+
+    state.index_text(guild_id, "reply", code, reply_content, confession_channel.id, reply_msg.id, time.time())
+    return confession_message is not None
+
+# Server picker. Every component is a DynamicItem whose custom_id carries the
+# draft id (and the guild or page), so pickers need no per-message view object
+# and keep working after a restart; the DM itself waits in state's draft store.
+PICKER_BUTTON_LIMIT = 5
+PICKER_PAGE_SIZE = 25
+
+def build_picker_view(draft_id, confession_channels, kind, page=0):
+    view = discord.ui.View(timeout=None)
+    style = discord.ButtonStyle.primary if kind == "confession" else discord.ButtonStyle.secondary
+    if len(confession_channels) <= PICKER_BUTTON_LIMIT:
+        for channel in confession_channels:
+            view.add_item(GuildPickButton(draft_id, channel.guild.id, label=channel.guild.name[:80], style=style))
+        return view
+
+    pages = (len(confession_channels) - 1) // PICKER_PAGE_SIZE + 1
+    page = max(0, min(page, pages - 1))
+    shown = confession_channels[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE]
+    options = [discord.SelectOption(label=channel.guild.name[:100], value=str(channel.guild.id)) for channel in shown]
+    view.add_item(GuildPickSelect(draft_id, page, options=options))
+    if pages > 1:
+        view.add_item(GuildPageButton(draft_id, page - 1, label="◀ Previous", disabled=page == 0))
+        view.add_item(GuildPageButton(draft_id, page + 1, label="Next ▶", disabled=page == pages - 1))
+    return view
+
+async def post_draft(interaction, draft, guild_id):
+    """Post a picked draft; returns its outcome, or None if the server is no longer available."""
+    confession_channels = await get_confession_channels(draft["user_id"])
+    confession_channel = discord.utils.get(confession_channels, guild__id=guild_id)
+    if confession_channel is None:
+        embed = discord.Embed(
+            title="❌ Server Unavailable",
+            description="You can no longer post in that server. Please send your message again.",
+            color=0xe74c3c
+        )
+        await interaction.edit_original_response(embed=embed, view=None)
+        return None
+    # process_confession / process_reply send their own confirmation.
+    if draft["kind"] == "confession":
+        return await process_confession(confession_channel, draft["user_id"], interaction.channel, draft["content"])
+    return await process_reply(confession_channel, draft["user_id"], interaction.channel, draft["code"], draft["content"])
+
+DRAFT_GONE = "⌛ This selection has expired or was already used. Please send your message again."
+
+async def complete_draft(interaction, draft_id, guild_id):
+    draft = state.pop_draft(draft_id)
+    if draft is None or draft["user_id"] != interaction.user.id:
+        if draft is not None:
+            state.restore_draft(draft_id, draft)
+        await interaction.response.send_message(DRAFT_GONE, ephemeral=True)
+        return
+    await interaction.response.defer()
+
+    priority = PRIORITY_REPLY if draft["kind"] == "reply" else PRIORITY_CONFESSION
+    with metrics.trace_dm(draft["kind"]):
+        try:
+            async with admission.slot(priority, draft["kind"]):
+                outcome = await post_draft(interaction, draft, guild_id)
+        except AdmissionRejected:
+            # Nothing was posted; put the draft back so the user can pick again.
+            state.restore_draft(draft_id, draft)
+            await interaction.followup.send("⏳ Whispr is very busy right now. Please try again in a minute.")
+            return
+    if outcome is None:
+        return
+    if outcome != "posted":
+        # The DM above already says what happened; just retire the picker.
+        embed = discord.Embed(title="Server Selected", description="See the message below.", color=0x95a5a6)
+        await interaction.edit_original_response(embed=embed, view=None)
+        return
+
+    embed = discord.Embed(
+        title="✅ Server Selected!",
+        description="Confession posted successfully!" if draft["kind"] == "confession" else "Reply posted successfully!",
+        color=0x00ff00
+    )
+    await interaction.edit_original_response(embed=embed, view=None)
+
+class GuildPickButton(discord.ui.DynamicItem[discord.ui.Button], template=r"whispr:pick:(?P<draft>[0-9a-f]+):(?P<guild>[0-9]+)"):
+    def __init__(self, draft_id, guild_id, label=None, style=discord.ButtonStyle.primary):
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=f"whispr:pick:{draft_id:x}:{guild_id}"))
+        self.draft_id = draft_id
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["draft"], 16), int(match["guild"]), label=item.label, style=item.style)
+
+    async def callback(self, interaction):
+        await complete_draft(interaction, self.draft_id, self.guild_id)
+
+class GuildPickSelect(discord.ui.DynamicItem[discord.ui.Select], template=r"whispr:select:(?P<draft>[0-9a-f]+):(?P<page>[0-9]+)"):
+    def __init__(self, draft_id, page, options=()):
+        super().__init__(discord.ui.Select(
+            placeholder="Choose a server…",
+            options=list(options),
+            custom_id=f"whispr:select:{draft_id:x}:{page}"
+        ))
+        self.draft_id = draft_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["draft"], 16), int(match["page"]), options=item.options)
+
+    async def callback(self, interaction):
+        await complete_draft(interaction, self.draft_id, int(self.item.values[0]))
+
+class GuildPageButton(discord.ui.DynamicItem[discord.ui.Button], template=r"whispr:page:(?P<draft>[0-9a-f]+):(?P<page>-?[0-9]+)"):
+    def __init__(self, draft_id, page, label=None, disabled=False):
+        super().__init__(discord.ui.Button(
+            label=label,
+            style=discord.ButtonStyle.secondary,
+            disabled=disabled,
+            custom_id=f"whispr:page:{draft_id:x}:{page}"
+        ))
+        self.draft_id = draft_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["draft"], 16), int(match["page"]), label=item.label, disabled=item.disabled)
+
+    async def callback(self, interaction):
+        draft = state.get_draft(self.draft_id)
+        if draft is None or draft["user_id"] != interaction.user.id:
+            await interaction.response.send_message(DRAFT_GONE, ephemeral=True)
+            return
+        confession_channels = await get_confession_channels(draft["user_id"])
+        view = build_picker_view(self.draft_id, confession_channels, draft["kind"], self.page)
+        await interaction.response.edit_message(view=view)
 
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
+    warm_started = time.perf_counter()
+    await build_member_index(state.guild_map)
+    problems = warm_confession_channels(state.guild_map)
+    if LEAN_MEMORY:
+        print(f'Lean memory mode: members are looked up on demand; warmed up in {time.perf_counter() - warm_started:.2f}s')
+    else:
+        print(f'Indexed members of {len(indexed_guilds)} configured servers in {time.perf_counter() - warm_started:.2f}s')
+    for guild_id, problem in problems.items():
+        print(f"Confession channel of server {guild_id} needs attention: {problem}")
+    if bot.started_at is not None:
+        # on_ready fires again after a full reconnect; only the first one is startup.
+        print(f"Ready to serve {time.perf_counter() - bot.started_at:.2f}s after startup")
+        bot.started_at = None
+
+@bot.event
+async def on_guild_available(guild):
+    if guild.id in state.guild_map and guild.id not in indexed_guilds and not LEAN_MEMORY:
+        if not guild.chunked:
+            await guild.chunk()
+        index_guild_members(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    unindex_guild(guild.id)
+    channel_health.pop(guild.id, None)
+    duplicate_filter.forget_guild(guild.id)
+    content_filter.forget_guild(guild.id)
+    member_lookup.forget_guild(guild.id)
+    non_member_cache.discard(lambda key: key[0] == guild.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    if state.guild_map.get(channel.guild.id) == channel.id:
+        await recheck_channel_health(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    # Covers permission overwrite changes on the confession channel.
+    if state.guild_map.get(after.guild.id) == after.id:
+        await recheck_channel_health(after.guild)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.permissions != after.permissions and after in after.guild.me.roles:
+        await recheck_channel_health(after.guild)
+
+@bot.event
+async def on_guild_role_delete(role):
+    await recheck_channel_health(role.guild)
+
+@bot.event
+async def on_member_update(before, after):
+    if after.id == bot.user.id and before.roles != after.roles:
+        await recheck_channel_health(after.guild)
+
+@bot.event
+async def on_member_join(member):
+    non_member_cache.pop((member.guild.id, member.id))
+    if member.guild.id in indexed_guilds and not member.bot:
+        member_guild_index.setdefault(member.id, set()).add(member.guild.id)
+        state.publish_member(member.guild.id, member.id, True)
+
+@bot.event
+async def on_raw_member_remove(payload):
+    unindex_member(payload.user.id, payload.guild_id)
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setup(ctx, channel: discord.TextChannel):
     """Set the confession channel for this server."""
-    permissions = channel.permissions_for(ctx.guild.me)
-    if not permissions.send_messages:
-        await ctx.send("❌ I don't have permission to send messages in that channel. Please give me 'Send Messages' permission.")
-        return
-    if not permissions.embed_links:
-        await ctx.send("❌ I don't have permission to send embeds in that channel. Please give me 'Embed Links' permission.")
-        return
-    if not permissions.add_reactions:
-        await ctx.send("❌ I don't have permission to add reactions in that channel. Please give me 'Add Reactions' permission.")
+    missing_perms = check_channel_permissions(channel)
+    if missing_perms:
+        await ctx.send(f"❌ I'm missing permissions in that channel: {', '.join(missing_perms)}. Please grant them and run `!setup` again.")
         return
     
-    guild_map = load_guild_map()
-    
-    existing_channel_id = guild_map.get(str(ctx.guild.id))
+    existing_channel_id = state.guild_map.get(ctx.guild.id)
     if existing_channel_id:
         existing_channel = bot.get_channel(existing_channel_id)
         if existing_channel:
@@ -283,8 +854,9 @@ async def setup(ctx, channel: discord.TextChannel):
         else:
             await ctx.send(f"⚠️ Previous confession channel no longer exists.\nSetting new channel to {channel.mention}...")
     
-    guild_map[str(ctx.guild.id)] = channel.id
-    save_guild_map(guild_map)
+    state.set_guild_channel(ctx.guild.id, channel.id)
+    channel_health.pop(ctx.guild.id, None)
+    index_guild_members(ctx.guild)
     
     await ctx.send(f"✅ Confession channel set to {channel.mention}")
     
@@ -311,12 +883,7 @@ async def setup_error(ctx, error):
 
 @bot.event
 async def on_guild_join(guild):
-    channel = guild.system_channel
-    if channel is None:
-        for c in guild.text_channels:
-            if c.permissions_for(guild.me).send_messages:
-                channel = c
-                break
+    channel = find_announcement_channel(guild)
     if channel:
         await channel.send(
             "**Hi! I'm Whispr, your anonymous confession bot!**\n"
@@ -325,183 +892,113 @@ async def on_guild_join(guild):
             "• Users can DM me to send confessions or anonymous replies!"
         )
 
-@bot.event
-async def on_message(message):
-    if message.author.bot:
+async def handle_dm(message):
+    confession_channels = await get_confession_channels(message.author.id)
+
+    if not confession_channels:
+        await message.channel.send(
+            "❌ No confession channel set up in servers where you're a member. Ask an admin to use `!setup #channel` in their server.\n"
+            "For more info, use `!whisprhelp` in the server."
+        )
         return
 
-    if isinstance(message.channel, discord.DMChannel):
-        confession_channels = []
-        guild_map = load_guild_map()
-        
-        user_guilds = []
-        for guild in bot.guilds:
-            try:
-                member = await guild.fetch_member(message.author.id)
-                if member:
-                    user_guilds.append(guild)
-            except discord.NotFound:
-                continue
-            except discord.Forbidden:
-                try:
-                    member = guild.get_member(message.author.id)
-                    if member:
-                        user_guilds.append(guild)
-                except:
-                    continue
-            except:
-                continue
-        
-        for guild in user_guilds:
-            channel_id = guild_map.get(str(guild.id))
-            if channel_id:
-                channel = bot.get_channel(channel_id)
-                if channel:
-                    confession_channels.append(channel)
-        
-        if not confession_channels:
-            await message.channel.send(
-                "❌ No confession channel set up in servers where you're a member. Ask an admin to use `!setup #channel` in their server.\n"
-                "For more info, use `!whisprhelp` in the server."
-            )
+    if message.content.lower().startswith("reply"):
+        parts = message.content.strip().split(maxsplit=2)
+        if len(parts) < 3:
+            await message.channel.send("❌ Invalid reply format. Use: reply #001 your message or reply 001 your message")
+            return
+        code_part = parts[1]
+        if code_part.startswith("#"):
+            code = code_part[1:]
+        else:
+            code = code_part
+        if not code.isdigit():
+            await message.channel.send("❌ Invalid confession code. Use: reply #001 your message or reply 001 your message")
+            return
+        reply_content = parts[2].strip()
+        if not reply_content:
+            await message.channel.send("❌ Your reply cannot be empty.")
             return
-        
-        if message.content.lower().startswith("reply"):
-            parts = message.content.strip().split(maxsplit=2)
-            if len(parts) < 3:
-                await message.channel.send("❌ Invalid reply format. Use: reply #001 your message or reply 001 your message")
-                return
-            code_part = parts[1]
-            if code_part.startswith("#"):
-                code = code_part[1:]
-            else:
-                code = code_part
-            if not code.isdigit():
-                await message.channel.send("❌ Invalid confession code. Use: reply #001 your message or reply 001 your message")
-                return
-            reply_content = parts[2].strip()
-            if not reply_content:
-                await message.channel.send("❌ Your reply cannot be empty.")
-                return
-
-            if len(confession_channels) > 1:
-                embed = discord.Embed(
-                    title="🎯 Choose Server for Reply",
-                    description=f"You want to reply to confession #{code}. Please select which server:",
-                    color=0x3498db
-                )
-                
-                view = ReplySelectView(confession_channels, message, code, reply_content)
-                await message.channel.send(embed=embed, view=view)
-                return
-            else:
-                confession_channel = confession_channels[0]
-                
-                confession_message = None
-                async for msg in confession_channel.history(limit=100):
-                    if (msg.author == bot.user and 
-                        msg.embeds and 
-                        msg.embeds[0].title and 
-                        msg.embeds[0].title.startswith(f"💬 Anonymous Confession #{int(code):03d}")):
-                        confession_message = msg
-                        break
-                
-                if confession_message:
-                    reply_embed = discord.Embed(
-                        title=f"💬 Anonymous Reply to Confession #{int(code):03d}",
-                        description=reply_content,
-                        color=0xe74c3c,
-                        timestamp=discord.utils.utcnow()
-                    )
-                    reply_embed.set_footer(text="This is an anonymous reply")
-                    
-                    await confession_channel.send(embed=reply_embed, reference=confession_message)
-                    await message.channel.send(f"✅ Your anonymous reply to confession #{int(code):03d} has been posted in **{confession_channel.guild.name}**!")
-                    
-                    confession_map = load_confession_map()
-                    user_id = confession_map.get(str(int(code)))
-                    if user_id:
-                        try:
-                            user = await bot.fetch_user(user_id)
-                            await user.send(
-                                f"📩 Your confession #{int(code):03d} received a new anonymous reply:\n{reply_content}"
-                            )
-                        except Exception:
-                            pass
-                else:
-                    # Create embed for reply when original confession not found
-                    reply_embed = discord.Embed(
-                        title=f"💬 Anonymous Reply to Confession #{int(code):03d}",
-                        description=reply_content,
-                        color=0xe74c3c,
-                        timestamp=discord.utils.utcnow()
-                    )
-                    reply_embed.set_footer(text="Original confession not found")
-                    
-                    await confession_channel.send(embed=reply_embed)
-                    await message.channel.send(f"⚠️ Confession #{int(code):03d} not found in **{confession_channel.guild.name}**. Your reply was posted as a normal message.")
-                return
 
         if len(confession_channels) > 1:
             embed = discord.Embed(
-                title="🎯 Choose Your Server",
-                description="You're in multiple servers with confession channels. Please select which server you want to send your confession to:",
+                title="🎯 Choose Server for Reply",
+                description=f"You want to reply to confession #{code}. Please select which server:",
                 color=0x3498db
             )
-            
-            view = ServerSelectView(confession_channels, message)
+    
+            draft_id = state.create_draft(message.author.id, "reply", reply_content, int(code))
+            view = build_picker_view(draft_id, confession_channels, "reply")
             await message.channel.send(embed=embed, view=view)
             return
-        
-        confession_channel = confession_channels[0]
-
-        # For single server, process confession directly without creating a view
-        guild_id = confession_channel.guild.id
-        key = (message.author.id, guild_id)
-        now = time.time()
-        last = user_last_confession.get(key, 0)
-        if now - last < CONFESSION_RATE_LIMIT:
-            await message.channel.send("⏳ Please wait before sending another confession in this server.")
+        else:
+            await process_reply(confession_channels[0], message.author.id, message.channel, code, reply_content)
             return
-        user_last_confession[key] = now
 
-        content = message.content.strip()
-        if not content:
-            await message.channel.send("❌ Your confession cannot be empty.")
-            return
-        
-        code = get_next_confession_code(guild_id)
-        
-        # Create embed for confession to prevent @everyone pings
+    if len(confession_channels) > 1:
         embed = discord.Embed(
-            title=f"💬 Anonymous Confession #{code:03d}",
-            description=content,
-            color=0x3498db,
-            timestamp=discord.utils.utcnow()
+            title="🎯 Choose Your Server",
+            description="You're in multiple servers with confession channels. Please select which server you want to send your confession to:",
+            color=0x3498db
         )
-        embed.set_footer(text=f"Reply using: DM me 'reply #{code:03d} your message'")
-        
-        confession_msg = await confession_channel.send(embed=embed)
-        await confession_msg.add_reaction("👍")
-        await confession_msg.add_reaction("👎")
-        
-        confession_map = load_confession_map()
-        confession_map[str(code)] = message.author.id
-        save_confession_map(confession_map)
-        
-        await message.channel.send(f"✅ Your confession has been posted anonymously in **{confession_channel.guild.name}**!")
-
-    await bot.process_commands(message)
+
+        draft_id = state.create_draft(message.author.id, "confession", message.content)
+        view = build_picker_view(draft_id, confession_channels, "confession")
+        await message.channel.send(embed=embed, view=view)
+        return
+
+    # For single server, process confession directly without creating a view
+    await process_confession(confession_channels[0], message.author.id, message.channel, message.content)
+
+@bot.event
+async def on_message(message):
+    if message.author.bot:
+        return
+
+    if isinstance(message.channel, discord.DMChannel):
+        kind = "reply" if message.content.lower().startswith("reply") else "confession"
+        priority = PRIORITY_REPLY if kind == "reply" else PRIORITY_CONFESSION
+        with metrics.trace_dm(kind):
+            try:
+                async with admission.slot(priority, kind):
+                    await handle_dm(message)
+            except AdmissionRejected:
+                await message.channel.send("⏳ Whispr is very busy right now. Please try again in a minute.")
+
+    if LEAN_MEMORY and message.guild is not None and message.guild.id in state.guild_map:
+        # Anyone talking in a configured server is a member; saves a lookup when they DM.
+        member_lookup.remember(message.guild.id, message.author.id, True)
+
+    if not message.content.startswith(bot.command_prefix):
+        return
+    ctx = await bot.get_context(message)
+    if not ctx.valid:
+        # Unknown commands, and other bots' "!" commands, cost nothing.
+        return
+    if ctx.command.extras.get("long_running"):
+        # Exports and imports do their work in batches between other work;
+        # holding a slot for minutes would only starve DMs.
+        await bot.invoke(ctx)
+        return
+    # Only admins jump the queue; anyone else's command waits like a confession.
+    is_admin = isinstance(message.author, discord.Member) and message.author.guild_permissions.administrator
+    priority = PRIORITY_COMMAND if is_admin else PRIORITY_CONFESSION
+    try:
+        async with admission.slot(priority, "command"):
+            await bot.invoke(ctx)
+    except AdmissionRejected:
+        await message.channel.send("⏳ Whispr is very busy right now. Please try again in a minute.")
 
 @bot.command(name="whisprhelp")
 async def whisprhelp(ctx):
     """Show help for Whispr bot."""
+    guild_id = ctx.guild.id if ctx.guild else None
     help_text = (
         "**Whispr Bot Help**\n"
         "• `!setup #channel` — Set the confession channel (admin only).\n"
         "• DM me your message — Send an anonymous confession.\n"
         "• DM me `reply #001 your message` — Reply anonymously to confession #001.\n"
-        "• Wait 30 seconds between confessions per server.\n"
+        f"• Rate limit: {describe_rate_limit(guild_id, 'confessions')} and {describe_rate_limit(guild_id, 'replies')} per server.\n"
         "• Confessions and replies are anonymous.\n"
         "• Only server admins can run `!setup`.\n"
         "• If you need more help, contact your server admin."
@@ -512,29 +1009,20 @@ async def whisprhelp(ctx):
 @commands.has_permissions(administrator=True)
 async def status(ctx):
     """Check if confession channel is set up for this server (admin only)."""
-    guild_map = load_guild_map()
-    channel_id = guild_map.get(str(ctx.guild.id))
+    channel_id = state.guild_map.get(ctx.guild.id)
     
     if not channel_id:
         await ctx.send("❌ No confession channel set up for this server.\nUse `!setup #channel` to set one up.")
         return
     
-    channel = bot.get_channel(channel_id)
+    health = get_channel_health(ctx.guild.id)
+    channel = health.channel
     if not channel:
         await ctx.send("❌ Confession channel was set but no longer exists.\nUse `!setup #channel` to set a new one.")
         return
     
-    permissions = channel.permissions_for(ctx.guild.me)
-    missing_perms = []
-    if not permissions.send_messages:
-        missing_perms.append("Send Messages")
-    if not permissions.embed_links:
-        missing_perms.append("Embed Links")
-    if not permissions.add_reactions:
-        missing_perms.append("Add Reactions")
-    
-    if missing_perms:
-        await ctx.send(f"⚠️ Confession channel: {channel.mention}\n❌ Missing permissions: {', '.join(missing_perms)}")
+    if health.missing:
+        await ctx.send(f"⚠️ Confession channel: {channel.mention}\n❌ Missing permissions: {', '.join(health.missing)}")
     else:
         await ctx.send(f"✅ Confession channel: {channel.mention}\n✅ All permissions are correct!")
 
@@ -543,4 +1031,537 @@ async def status_error(ctx, error):
     if isinstance(error, commands.MissingPermissions):
         await ctx.send("❌ You need administrator permissions to use this command.")
 
-bot.run(TOKEN)
\ No newline at end of file
+@bot.command(name="ratelimit")
+@commands.has_permissions(administrator=True)
+async def ratelimit(ctx, kind: str = None, limit: int = None, seconds: int = None):
+    """Show or change the confession and reply rate limits for this server (admin only)."""
+    if kind is None:
+        await ctx.send(
+            f"⏳ Confessions: {describe_rate_limit(ctx.guild.id, 'confessions')} per user.\n"
+            f"⏳ Replies: {describe_rate_limit(ctx.guild.id, 'replies')} per user."
+        )
+        return
+    if kind not in DEFAULT_POLICIES or limit is None or seconds is None:
+        await ctx.send("❌ Usage: `!ratelimit confessions|replies <count> <seconds>`\nExample: `!ratelimit confessions 1 30`")
+        return
+    if limit < 1 or seconds < 1:
+        await ctx.send("❌ Count and seconds must both be at least 1.")
+        return
+    state.set_guild_setting(ctx.guild.id, f"rate_limit_{kind}", [limit, seconds])
+    await ctx.send(f"✅ {kind.capitalize()} are now limited to {describe_rate_limit(ctx.guild.id, kind)} per user.")
+
+@ratelimit.error
+async def ratelimit_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send("❌ Usage: `!ratelimit confessions|replies <count> <seconds>`")
+
+def describe_duplicate_policy(policy):
+    if policy["action"] == "off":
+        return "Near-duplicate detection is off."
+    verb = "rejected" if policy["action"] == "reject" else "held for review"
+    return (f"Confessions within {policy['distance']} bits of one posted in the last "
+            f"{policy['window']} seconds are {verb}.")
+
+@bot.command(name="duplicates")
+@commands.has_permissions(administrator=True)
+async def duplicates(ctx, action: str = None, distance: int = None, window: int = None):
+    """Show or change near-duplicate confession handling for this server (admin only)."""
+    if action is None:
+        stats = duplicate_filter.snapshot()
+        await ctx.send(
+            f"🔁 {describe_duplicate_policy(get_duplicate_policy(ctx.guild.id))}\n"
+            f"Since startup (all servers): {stats['checked']} checked, {stats['rejected']} rejected, {stats['held']} held."
+        )
+        return
+    if action not in DUPLICATE_ACTIONS:
+        await ctx.send("❌ Usage: `!duplicates off|reject|hold [distance 0-7] [window seconds]`\nExample: `!duplicates hold 6 600`")
+        return
+    policy = get_duplicate_policy(ctx.guild.id)
+    policy["action"] = action
+    if distance is not None:
+        if not 0 <= distance <= MAX_DISTANCE:
+            await ctx.send(f"❌ Distance must be between 0 and {MAX_DISTANCE}.")
+            return
+        policy["distance"] = distance
+    if window is not None:
+        if window < 1:
+            await ctx.send("❌ Window must be at least 1 second.")
+            return
+        policy["window"] = window
+    state.set_guild_setting(ctx.guild.id, "duplicates", policy)
+    await ctx.send(f"✅ {describe_duplicate_policy(policy)}")
+
+@duplicates.error
+async def duplicates_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send("❌ Usage: `!duplicates off|reject|hold [distance 0-7] [window seconds]`")
+
+HELD_PREVIEW = 10
+
+@bot.command(name="held")
+@commands.has_permissions(administrator=True)
+async def held(ctx):
+    """List confessions and replies held for review in this server (admin only)."""
+    total, entries = await state.list_holds(ctx.guild.id, HELD_PREVIEW)
+    if not entries:
+        await ctx.send("✅ Nothing is waiting for review.")
+        return
+    lines = [f"**Held for Review** ({total})"]
+    for hold_id, entry in entries:
+        preview = entry["content"].replace("\n", " ")
+        if len(preview) > 80:
+            preview = preview[:79] + "…"
+        label = f"reply to #{entry['code']:03d}" if entry["kind"] == "reply" else "confession"
+        lines.append(f"• `{hold_id}` ({label}, {entry['reason']}): {preview}")
+    if total > len(entries):
+        lines.append(f"…and {total - len(entries)} more")
+    lines.append("Use `!approve <id>` to post one or `!discard <id>` to drop it.")
+    await ctx.send("\n".join(lines))
+
+@bot.command(name="approve")
+@commands.has_permissions(administrator=True)
+async def approve(ctx, hold_id: int):
+    """Post a held confession or reply (admin only)."""
+    health = get_channel_health(ctx.guild.id)
+    if not health.can_post:
+        await ctx.send("❌ The confession channel isn't usable right now. Check it with `!status`.")
+        return
+    entry = await state.pop_hold(ctx.guild.id, hold_id)
+    if entry is None:
+        await ctx.send(f"❌ Nothing is held with id `{hold_id}`.")
+        return
+    if entry["kind"] == "reply":
+        await post_reply(health.channel, entry["code"], entry["content"])
+        await ctx.send(f"✅ Posted as a reply to confession #{entry['code']:03d} in {health.channel.mention}.")
+        return
+    code = await post_confession(health.channel, entry["author_id"], entry["content"])
+    await ctx.send(f"✅ Posted as confession #{code:03d} in {health.channel.mention}.")
+
+@bot.command(name="discard")
+@commands.has_permissions(administrator=True)
+async def discard(ctx, hold_id: int):
+    """Drop a held confession or reply without posting it (admin only)."""
+    if await state.pop_hold(ctx.guild.id, hold_id) is None:
+        await ctx.send(f"❌ Nothing is held with id `{hold_id}`.")
+        return
+    await ctx.send(f"🗑️ Discarded held message `{hold_id}`.")
+
+@held.error
+@approve.error
+@discard.error
+async def held_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+    elif isinstance(error, (commands.MissingRequiredArgument, commands.BadArgument)):
+        await ctx.send("❌ Usage: `!approve <id>` or `!discard <id>`. Use `!held` to see the ids.")
+
+FILTER_USAGE = (
+    "❌ Usage: `!filter word reject|hold|mask <word or phrase>`, `!filter regex reject|hold|mask <pattern>`, "
+    "`!filter remove <word, phrase or pattern>` or `!filter clear`\n"
+    "Example: `!filter regex hold free\\s+nitro`"
+)
+FILTER_PREVIEW_RULES = 10
+FILTER_ACTION_VERBS = {"reject": "rejected", "hold": "held for review", "mask": "posted with the match blanked out"}
+
+def describe_filter(rules):
+    words, patterns = rules["words"], rules["patterns"]
+    if not words and not patterns:
+        return "🧹 No content filter rules are set. Add one with `!filter word|regex reject|hold|mask <rule>`."
+    lines = [f"🧹 **Content Filter**: {len(words)} words or phrases, {len(patterns)} regex rules"]
+    for action in FILTER_ACTIONS:
+        # Spoilered, so reading the rules doesn't mean reading the abuse.
+        entries = [f"||{word[:40]}||" for word, rule_action in words.items() if rule_action == action]
+        entries += [f"||`{pattern[:40]}`||" for pattern, rule_action in patterns.items() if rule_action == action]
+        if entries:
+            more = f" …and {len(entries) - FILTER_PREVIEW_RULES} more" if len(entries) > FILTER_PREVIEW_RULES else ""
+            lines.append(f"• {action}: {', '.join(entries[:FILTER_PREVIEW_RULES])}{more}")
+    return "\n".join(lines)
+
+@bot.command(name="filter")
+@commands.has_permissions(administrator=True)
+async def filter_rules(ctx, kind: str = None, *, rest: str = None):
+    """Show or change this server's blocked words and regex rules (admin only)."""
+    rules = get_filter_rules(ctx.guild.id)
+    if kind is None:
+        stats = content_filter.snapshot()
+        await ctx.send(
+            f"{describe_filter(rules)}\n"
+            f"Since startup (all servers): {stats['checked']} checked, {stats['rejected']} rejected, "
+            f"{stats['held']} held, {stats['masked']} masked, "
+            f"{stats['pattern_timeouts']} regex scans timed out."
+        )
+        return
+    if kind == "clear":
+        rules["words"].clear()
+        rules["patterns"].clear()
+        save_filter_rules(ctx.guild.id, rules)
+        await ctx.send("✅ Removed every content filter rule in this server.")
+        return
+    if kind == "remove" and rest:
+        rule = rest.strip("`")
+        word = normalize_word(rule)
+        if rules["words"].pop(word, None) is None and rules["patterns"].pop(rule, None) is None:
+            await ctx.send("❌ No rule matches that. Use `!filter` to see this server's rules.")
+            return
+        save_filter_rules(ctx.guild.id, rules)
+        await ctx.send("✅ Rule removed.")
+        return
+
+    action, _, rule = (rest or "").partition(" ")
+    # Backticks keep Discord from formatting a pattern; they aren't part of it.
+    rule = rule.strip().strip("`")
+    if kind not in ("word", "regex") or action not in FILTER_ACTIONS or not rule:
+        await ctx.send(FILTER_USAGE)
+        return
+    if kind == "word":
+        word = normalize_word(rule)
+        if word not in rules["words"] and len(rules["words"]) >= MAX_FILTER_WORDS:
+            await ctx.send(f"❌ A server can have at most {MAX_FILTER_WORDS} words and phrases.")
+            return
+        rules["words"][word] = action
+    else:
+        problem = validate_pattern(rule)
+        if problem is not None:
+            await ctx.send(f"❌ Can't use that pattern: {problem}.")
+            return
+        if rule not in rules["patterns"] and len(rules["patterns"]) >= MAX_FILTER_PATTERNS:
+            await ctx.send(f"❌ A server can have at most {MAX_FILTER_PATTERNS} regex rules.")
+            return
+        rules["patterns"][rule] = action
+    save_filter_rules(ctx.guild.id, rules)
+    await ctx.send(f"✅ Confessions and replies matching that {kind} will be {FILTER_ACTION_VERBS[action]}.")
+
+@filter_rules.error
+async def filter_rules_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+SEARCH_PAGE_SIZE = 5
+
+def format_search_page(guild_id, terms, results, page):
+    if not results:
+        return f"🔎 No confessions or replies match **{terms}**." if page == 0 else "🔎 No more results."
+    lines = [f"🔎 Results for **{terms}** (page {page + 1})"]
+    for result in results[:SEARCH_PAGE_SIZE]:
+        label = "Confession" if result["kind"] == "confession" else "Reply to confession"
+        link = f"https://discord.com/channels/{guild_id}/{result['channel_id']}/{result['message_id']}"
+        posted = f"<t:{int(result['created_at'])}:d>" if result["created_at"] else ""
+        snippet = result["snippet"].replace("\n", " ")
+        lines.append(f"• [{label} #{result['code']:03d}]({link}) {posted}\n  {snippet}")
+    return "\n".join(lines)
+
+class SearchView(discord.ui.View):
+    """Previous/next buttons for a !search result, usable by the admin who ran it."""
+    def __init__(self, author_id, guild_id, terms, page, has_next):
+        super().__init__(timeout=120)
+        self.author_id = author_id
+        self.guild_id = guild_id
+        self.terms = terms
+        self.page = page
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = not has_next
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("❌ This is not your search.", ephemeral=True)
+            return False
+        return True
+
+    async def show(self, interaction, page):
+        results = await state.search(self.guild_id, self.terms, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+        view = SearchView(self.author_id, self.guild_id, self.terms, page, len(results) > SEARCH_PAGE_SIZE)
+        await interaction.response.edit_message(content=format_search_page(self.guild_id, self.terms, results, page), view=view)
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, self.page + 1)
+
+@bot.command(name="search")
+@commands.has_permissions(administrator=True)
+async def search(ctx, *, terms: str):
+    """Full-text search over this server's confessions and replies (admin only)."""
+    if not state.searchable:
+        await ctx.send("❌ Search needs the SQLite storage backend.")
+        return
+    # Posts from the last few seconds may still be waiting for the write-behind flush.
+    results = await state.search(ctx.guild.id, terms, SEARCH_PAGE_SIZE + 1)
+    view = SearchView(ctx.author.id, ctx.guild.id, terms, 0, len(results) > SEARCH_PAGE_SIZE)
+    await ctx.send(format_search_page(ctx.guild.id, terms, results, 0), view=view, suppress_embeds=True)
+
+@search.error
+async def search_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+    elif isinstance(error, commands.MissingRequiredArgument):
+        await ctx.send("❌ Usage: `!search <words>`\nExample: `!search birthday party`")
+
+def describe_retention(retention):
+    authors = f"after {retention['author_days']} days" if retention["author_days"] else "never"
+    content = f"after {retention['content_days']} days" if retention["content_days"] else "never"
+    return f"Author links are removed {authors}; searchable text is removed {content}."
+
+@bot.command(name="retention")
+@commands.has_permissions(administrator=True)
+async def retention(ctx, kind: str = None, days: str = None):
+    """Show or change how long author links and searchable text are kept (admin only)."""
+    if kind is None:
+        await ctx.send(f"🗄️ {describe_retention(state.get_retention(ctx.guild.id))}")
+        return
+    if kind not in ("authors", "content") or days is None or not (days == "off" or days.isdigit()):
+        await ctx.send("❌ Usage: `!retention authors|content <days>|off`\nExample: `!retention authors 90`")
+        return
+    if not state.retainable:
+        await ctx.send("❌ Retention needs the SQLite storage backend.")
+        return
+    if days != "off" and int(days) < 1:
+        await ctx.send("❌ Days must be at least 1.")
+        return
+    policy = state.get_retention(ctx.guild.id)
+    policy["author_days" if kind == "authors" else "content_days"] = None if days == "off" else int(days)
+    state.set_guild_setting(ctx.guild.id, "retention", policy)
+    await ctx.send(
+        f"✅ {describe_retention(policy)}\n"
+        "Without an author link, the original poster no longer gets reply notifications."
+    )
+
+@retention.error
+async def retention_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+@bot.command(name="compaction")
+@commands.has_permissions(administrator=True)
+async def compaction(ctx):
+    """Show what the background compaction job has pruned (admin only)."""
+    report = state.compaction_report
+    totals = state.compaction_totals
+    lines = [
+        "**Compaction**",
+        f"• This server: {describe_retention(state.get_retention(ctx.guild.id))}",
+        f"• Confessions cached in memory: {len(state.confessions)} (last {state.cache_days:g} days)",
+    ]
+    if report is None:
+        lines.append(f"• No pass has run yet; passes run every {state.compaction_interval:g} seconds.")
+    else:
+        lines.append(
+            f"• Last pass <t:{int(report['started_at'])}:R>: {report['guilds']} servers, {report['batches']} batches, "
+            f"{report['duration'] * 1000:.0f} ms"
+        )
+        lines.append(
+            f"• Last pass pruned: {report['authors_unlinked']} author links, {report['search_pruned']} search entries, "
+            f"{report['evicted']} cached confessions"
+        )
+        lines.append(
+            f"• Since startup ({totals['passes']} passes): {totals['authors_unlinked']} author links, "
+            f"{totals['search_pruned']} search entries, {totals['evicted']} cached confessions"
+        )
+    await ctx.send("\n".join(lines))
+
+@compaction.error
+async def compaction_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(50 * 2 ** 20)))
+IMPORT_DOWNLOAD_CHUNK = 64 * 1024
+transfers_running = set()   # guild ids with an export or import in progress
+
+@bot.command(name="export", extras={"long_running": True})
+@commands.has_permissions(administrator=True)
+async def export_data(ctx):
+    """DM this server's confession data to you as compressed JSON Lines (admin only)."""
+    if ctx.guild.id in transfers_running:
+        await ctx.send("⏳ An export or import is already running for this server.")
+        return
+    transfers_running.add(ctx.guild.id)
+    loop = asyncio.get_running_loop()
+    try:
+        with tempfile.TemporaryDirectory(prefix="whispr-export-") as directory:
+            writer = ExportWriter(directory, ctx.guild.id, EXPORT_PART_SIZE)
+            try:
+                exported = await state.export_guild(ctx.guild.id, writer)
+            finally:
+                await loop.run_in_executor(None, writer.close)
+            # Author links de-anonymise every confession, so the file only goes to the admin's DMs.
+            try:
+                for part, path in enumerate(writer.paths, 1):
+                    await ctx.author.send(
+                        f"📦 Whispr export of **{ctx.guild.name}**, part {part} of {len(writer.paths)}",
+                        file=discord.File(path)
+                    )
+            except discord.Forbidden:
+                await ctx.send("❌ I couldn't DM you the export. Allow DMs from server members and try again.")
+                return
+        await ctx.send(
+            f"📬 Sent you {exported} confessions in {len(writer.paths)} file(s). "
+            "Keep them private: they link every confession to its author."
+        )
+    finally:
+        transfers_running.discard(ctx.guild.id)
+
+@export_data.error
+async def export_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+async def download_attachment(attachment, path):
+    """Stream an attachment to disk without holding it in memory."""
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                async for chunk in response.content.iter_chunked(IMPORT_DOWNLOAD_CHUNK):
+                    await loop.run_in_executor(None, f.write, chunk)
+
+@bot.command(name="import", extras={"long_running": True})
+@commands.has_permissions(administrator=True)
+async def import_data(ctx):
+    """Import a Whispr export attached to the command; nothing already here is overwritten (admin only)."""
+    attachments = ctx.message.attachments
+    if not attachments:
+        await ctx.send("❌ Usage: attach the files from `!export` to a `!import` message.")
+        return
+    if CLUSTER_MODE and not HANDLES_DMS:
+        # Confession numbers are handed out in blocks by the process serving
+        # shard 0, which wouldn't see the imported counter and would reuse numbers.
+        await ctx.send("❌ In a cluster, `!import` only works in servers on shard 0. Run Whispr unsharded for the import.")
+        return
+    too_big = [attachment.filename for attachment in attachments if attachment.size > IMPORT_MAX_BYTES]
+    if too_big:
+        await ctx.send(f"❌ Imports are limited to {IMPORT_MAX_BYTES // 2 ** 20} MB per file: {', '.join(too_big)}")
+        return
+    if ctx.guild.id in transfers_running:
+        await ctx.send("⏳ An export or import is already running for this server.")
+        return
+    transfers_running.add(ctx.guild.id)
+    loop = asyncio.get_running_loop()
+    totals = {"confessions": 0, "existing": 0, "settings": 0, "channel": False}
+    try:
+        with tempfile.TemporaryDirectory(prefix="whispr-import-") as directory:
+            paths = []
+            for i, attachment in enumerate(attachments):
+                path = os.path.join(directory, f"part{i}")
+                await download_attachment(attachment, path)
+                paths.append((attachment.filename, path))
+            # The file links confessions to their authors; don't leave it up in the channel.
+            try:
+                await ctx.message.delete()
+            except discord.HTTPException:
+                pass
+            for filename, path in paths:
+                try:
+                    reader = await loop.run_in_executor(None, ImportReader, path, ctx.guild.id)
+                    try:
+                        report = await state.import_guild(ctx.guild.id, reader)
+                    finally:
+                        reader.close()
+                except TransferError as e:
+                    await ctx.send(
+                        f"❌ Stopped at `{filename}`: {e}. Everything before that point was imported; "
+                        "fix the file and run the import again."
+                    )
+                    return
+                for key in ("confessions", "existing", "settings"):
+                    totals[key] += report[key]
+                totals["channel"] = totals["channel"] or report["channel"]
+    except aiohttp.ClientError as e:
+        await ctx.send(f"❌ Couldn't download the attachment: {e}")
+        return
+    finally:
+        transfers_running.discard(ctx.guild.id)
+    await ctx.send(
+        f"✅ Imported {totals['confessions']} confessions ({totals['existing']} were already here) "
+        f"and {totals['settings']} settings"
+        + (", and set the confession channel." if totals["channel"] else ".")
+    )
+
+@import_data.error
+async def import_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+@bot.command(name="pipeline")
+@commands.has_permissions(administrator=True)
+async def pipeline(ctx):
+    """Show outbound queue depth, per-stage latency and notification stats (admin only)."""
+    snapshot = send_pipeline.snapshot()
+    lines = [
+        "**Send Pipeline**",
+        f"• Queued messages: {sum(snapshot['queue_depth'].values())} across {len(snapshot['queue_depth'])} channels",
+        f"• Pending reactions: {snapshot['pending_reactions']}",
+    ]
+    for name, stage in snapshot["stages"].items():
+        lines.append(
+            f"• `{name}`: {stage['count']} done, {stage['errors']} failed, "
+            f"avg {stage['avg'] * 1000:.0f} ms, max {stage['max'] * 1000:.0f} ms"
+        )
+    notifications = reply_notifier.snapshot()
+    lines.append(
+        f"• Reply notifications: {notifications['sent']} sent, {notifications['coalesced']} coalesced, "
+        f"{notifications['failed']} failed, {notifications['pending_recipients']} recipients pending"
+    )
+    await ctx.send("\n".join(lines))
+
+@pipeline.error
+async def pipeline_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    """Show per-stage latency, REST usage and rate-limit hits since startup (admin only)."""
+    lines = ["**Whispr Stats** (p50 / p99 are bucket upper bounds)"]
+    for kind in ("confession", "reply"):
+        handled = metrics.dm_seconds.summary(kind=kind)
+        if handled:
+            calls = metrics.dm_rest_calls.summary(kind=kind)
+            lines.append(
+                f"• {kind.capitalize()} DMs: {handled['count']}, p50 {handled['p50'] * 1000:.0f} ms, "
+                f"p99 {handled['p99'] * 1000:.0f} ms, {calls['avg']:.1f} REST calls each"
+            )
+    for (stage,) in sorted(metrics.stage_seconds.series):
+        summary = metrics.stage_seconds.summary(stage=stage)
+        lines.append(
+            f"• `{stage}`: {summary['count']} samples, avg {summary['avg'] * 1000:.1f} ms, "
+            f"p50 {summary['p50'] * 1000:.0f} ms, p99 {summary['p99'] * 1000:.0f} ms"
+        )
+    admitted = admission.snapshot()
+    lines.append(
+        f"• Admission: {admitted['active']} running, {admitted['waiting']} queued, "
+        f"{admitted['admitted']} admitted, {admitted['shed']} turned away as busy"
+    )
+    if LEAN_MEMORY:
+        lookups = member_lookup.snapshot()
+        lines.append(
+            f"• Member lookups: {lookups['hits']} cached, {lookups['misses']} asked, "
+            f"{lookups['queries']} gateway queries, {lookups['rest_lookups']} REST, {lookups['failures']} failed"
+        )
+    lines.append(f"• REST requests: {metrics.rest_requests.total()}")
+    lines.append(
+        f"• Discord 429s: {metrics.discord_rate_limits.total()}, "
+        f"users rate limited: {metrics.user_rate_limits.total()}"
+    )
+    await ctx.send("\n".join(lines))
+
+@stats.error
+async def stats_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send("❌ You need administrator permissions to use this command.")
+
+def main():
+    if not TOKEN:
+        raise RuntimeError("Missing TOKEN in .env file.")
+    bot.run(TOKEN)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Whispr cluster launcher.
+
+Runs the bot as several processes, each serving a contiguous group of
+gateway shards, all sharing one SQLite database:
+   python cluster.py --shards 8 --clusters 2
+
+Discord delivers DMs (and DM button interactions) on shard 0 only, so the
+process owning shard 0 handles every confession and reply. The others serve
+their guilds' commands and events and publish membership and guild names to
+the shared database so that process can route DMs to any guild.
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+
+from storage import open_storage
+
+RESTART_DELAY = 5
+
+
+def shard_groups(shard_count, cluster_count):
+    size, extra = divmod(shard_count, cluster_count)
+    groups = []
+    start = 0
+    for i in range(cluster_count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+def spawn(cluster_id, shard_count, shard_ids):
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=",".join(str(shard_id) for shard_id in shard_ids),
+        CLUSTER_MODE="1",
+        CLUSTER_ID=str(cluster_id),
+    )
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    print(f"Starting cluster {cluster_id} with shards {shard_ids}")
+    return subprocess.Popen([sys.executable, bot_path], env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Whispr as multiple shard processes")
+    parser.add_argument("--shards", type=int, required=True, help="total number of gateway shards")
+    parser.add_argument("--clusters", type=int, required=True, help="number of processes")
+    args = parser.parse_args()
+
+    if args.clusters < 1 or args.shards < args.clusters:
+        parser.error("need at least one shard per cluster")
+    if os.getenv("STORAGE_BACKEND", "sqlite") != "sqlite":
+        parser.error("cluster mode requires STORAGE_BACKEND=sqlite")
+
+    # Run the one-shot JSON migration here so the processes don't race on it.
+    open_storage().close()
+
+    groups = shard_groups(args.shards, args.clusters)
+    procs = {i: spawn(i, args.shards, shard_ids) for i, shard_ids in enumerate(groups)}
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while not stopping:
+        time.sleep(1)
+        for cluster_id, proc in procs.items():
+            if proc.poll() is not None and not stopping:
+                print(f"Cluster {cluster_id} exited with code {proc.returncode}; restarting in {RESTART_DELAY}s")
+                time.sleep(RESTART_DELAY)
+                procs[cluster_id] = spawn(cluster_id, args.shards, groups[cluster_id])
+
+    for proc in procs.values():
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in procs.values():
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+if __name__ == "__main__":
+    main()
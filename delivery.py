@@ -0,0 +1,328 @@
+"""
+Outbound delivery for Whispr.
+
+SendPipeline puts one queue and worker in front of every confession channel.
+Sends are paced to the channel's message route bucket (5 messages per 5
+seconds by default), so bursts are smoothed out instead of piling into 429
+retries inside the request handler. Reactions run as background tasks,
+bounded by a global semaphore and paced per channel, so callers can
+acknowledge the user as soon as the message exists.
+
+ReplyNotifier sends "your confession got a reply" DMs from background tasks.
+The first reply to a recipient goes out immediately; replies arriving within
+the following coalescing window are merged into a single digest DM. DM
+channels are kept in a small TTL/LRU cache so repeat notifications don't
+need a fetch_user round trip.
+"""
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+import aiohttp
+import discord
+
+import metrics
+
+CHANNEL_SEND_RATE = int(os.getenv("CHANNEL_SEND_RATE", "5"))
+CHANNEL_SEND_PER = float(os.getenv("CHANNEL_SEND_PER", "5.0"))
+REACTION_INTERVAL = float(os.getenv("REACTION_INTERVAL", "0.25"))
+REACTION_CONCURRENCY = int(os.getenv("REACTION_CONCURRENCY", "4"))
+WORKER_IDLE_TIMEOUT = 60
+
+NOTIFY_COALESCE_WINDOW = float(os.getenv("NOTIFY_COALESCE_WINDOW", "30"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+NOTIFY_RETRY_BASE = 1.0
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "3600"))
+DIGEST_REPLY_PREVIEW = 300
+DM_MAX_LENGTH = 2000
+
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, error=False):
+        metrics.observe_stage(self.name, seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if error:
+            self.errors += 1
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class SendPipeline:
+    def __init__(self, rate=CHANNEL_SEND_RATE, per=CHANNEL_SEND_PER,
+                 reaction_interval=REACTION_INTERVAL, reaction_concurrency=REACTION_CONCURRENCY):
+        self.rate = rate
+        self.per = per
+        self.reaction_interval = reaction_interval
+        self._queues = {}           # channel_id -> asyncio.Queue
+        self._workers = {}          # channel_id -> worker task
+        self._reaction_locks = {}   # channel_id -> asyncio.Lock
+        self._reaction_slots = asyncio.Semaphore(reaction_concurrency)
+        self._background = set()
+        self.stages = {
+            "queue_wait": StageStats("queue_wait"),
+            "channel_send": StageStats("channel_send"),
+            "reactions": StageStats("reactions"),
+        }
+        self.pending_reactions = 0
+
+    async def send(self, channel, **kwargs):
+        """Queue a message for the channel and wait until it has been created."""
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((channel, kwargs, future, time.monotonic(), metrics.current_dm.get()))
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._worker(channel.id, queue))
+        return await future
+
+    async def _worker(self, channel_id, queue):
+        bucket = TokenBucket(self.rate, self.per)
+        try:
+            while True:
+                try:
+                    channel, kwargs, future, enqueued, dm_trace = await asyncio.wait_for(
+                        queue.get(), WORKER_IDLE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                if future.cancelled():
+                    continue
+                await bucket.acquire()
+                started = time.monotonic()
+                self.stages["queue_wait"].observe(started - enqueued)
+                # Attribute the request to the DM that queued it, not to
+                # whichever DM happened to start this worker.
+                trace_token = metrics.current_dm.set(dm_trace)
+                try:
+                    message = await channel.send(**kwargs)
+                except Exception as e:
+                    self.stages["channel_send"].observe(time.monotonic() - started, error=True)
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.stages["channel_send"].observe(time.monotonic() - started)
+                    if not future.done():
+                        future.set_result(message)
+                finally:
+                    metrics.current_dm.reset(trace_token)
+        finally:
+            self._workers.pop(channel_id, None)
+            if queue.empty():
+                self._queues.pop(channel_id, None)
+
+    def add_reactions(self, message, emojis):
+        """Add reactions in the background, in order, without blocking the caller."""
+        self.pending_reactions += 1
+        task = asyncio.create_task(self._react(message, emojis))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _react(self, message, emojis):
+        channel_id = message.channel.id
+        lock = self._reaction_locks.get(channel_id)
+        if lock is None:
+            lock = self._reaction_locks[channel_id] = asyncio.Lock()
+        started = time.monotonic()
+        error = False
+        try:
+            async with self._reaction_slots:
+                for emoji in emojis:
+                    # The reaction route allows one request per interval per channel.
+                    async with lock:
+                        try:
+                            await message.add_reaction(emoji)
+                        except Exception as e:
+                            error = True
+                            print(f"Failed to add reaction {emoji}: {e}")
+                        await asyncio.sleep(self.reaction_interval)
+        finally:
+            self.pending_reactions -= 1
+            self.stages["reactions"].observe(time.monotonic() - started, error=error)
+
+    def snapshot(self):
+        return {
+            "queue_depth": {channel_id: queue.qsize() for channel_id, queue in self._queues.items()},
+            "pending_reactions": self.pending_reactions,
+            "stages": {name: stats.snapshot() for name, stats in self.stages.items()},
+        }
+
+    async def close(self):
+        tasks = list(self._workers.values()) + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ttl seconds."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def discard(self, predicate):
+        """Drop every entry whose key matches the predicate."""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ReplyNotifier:
+    def __init__(self, client, window=NOTIFY_COALESCE_WINDOW, max_retries=NOTIFY_MAX_RETRIES,
+                 cache_size=USER_CACHE_SIZE, cache_ttl=USER_CACHE_TTL):
+        self.client = client
+        self.window = window
+        self.max_retries = max_retries
+        self._dm_channels = TTLCache(cache_size, cache_ttl)
+        self._pending = {}      # user_id -> replies waiting for the next digest
+        self._tasks = set()
+        self.stats = {"queued": 0, "sent": 0, "coalesced": 0, "failed": 0, "cache_hits": 0, "cache_misses": 0}
+
+    def notify(self, user_id, code, reply_content):
+        """Queue a reply notification; returns immediately."""
+        self.stats["queued"] += 1
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            # A notification went out recently; fold this one into the digest.
+            pending.append((code, reply_content))
+            self.stats["coalesced"] += 1
+            return
+        self._pending[user_id] = []
+        task = asyncio.create_task(self._dispatch(user_id, [(code, reply_content)]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, user_id, replies):
+        try:
+            while replies:
+                await self._deliver(user_id, format_notification(replies))
+                await asyncio.sleep(self.window)
+                replies = self._pending[user_id]
+                self._pending[user_id] = []
+        finally:
+            self._pending.pop(user_id, None)
+
+    async def _get_dm_channel(self, user_id):
+        channel = self._dm_channels.get(user_id)
+        if channel is not None:
+            self.stats["cache_hits"] += 1
+            return channel
+        self.stats["cache_misses"] += 1
+        user = self.client.get_user(user_id) or await self.client.fetch_user(user_id)
+        channel = user.dm_channel or await user.create_dm()
+        self._dm_channels.set(user_id, channel)
+        return channel
+
+    async def _deliver(self, user_id, content):
+        with metrics.timer("notification_dm"):
+            await self._deliver_with_retries(user_id, content)
+
+    async def _deliver_with_retries(self, user_id, content):
+        for attempt in range(self.max_retries + 1):
+            try:
+                channel = await self._get_dm_channel(user_id)
+                await channel.send(content)
+                self.stats["sent"] += 1
+                return
+            except (discord.Forbidden, discord.NotFound):
+                # DMs closed or the account is gone; retrying won't help.
+                self._dm_channels.pop(user_id)
+                break
+            except discord.HTTPException as e:
+                if e.status < 500 and e.status != 429:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if attempt < self.max_retries:
+                await asyncio.sleep(NOTIFY_RETRY_BASE * 2 ** attempt)
+        self.stats["failed"] += 1
+
+    def snapshot(self):
+        return dict(self.stats, pending_recipients=len(self._pending), cached_dm_channels=len(self._dm_channels))
+
+    async def close(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def format_notification(replies):
+    if len(replies) == 1:
+        code, reply_content = replies[0]
+        return f"📩 Your confession #{code:03d} received a new anonymous reply:\n{reply_content}"[:DM_MAX_LENGTH]
+
+    lines = [f"📩 Your confessions received {len(replies)} new anonymous replies:"]
+    length = len(lines[0])
+    for i, (code, reply_content) in enumerate(replies):
+        if len(reply_content) > DIGEST_REPLY_PREVIEW:
+            reply_content = reply_content[:DIGEST_REPLY_PREVIEW - 1] + "…"
+        line = f"• **#{code:03d}:** {reply_content}"
+        more = f"…and {len(replies) - i} more"
+        if length + len(line) + len(more) + 2 > DM_MAX_LENGTH:
+            lines.append(more)
+            break
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
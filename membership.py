@@ -0,0 +1,127 @@
+"""
+On-demand membership lookups for lean-memory mode.
+
+Without the members intent the bot has no member lists, so "is this DM
+author in guild X?" is asked of Discord when a DM arrives. Lookups for the
+same guild that arrive within MEMBER_BATCH_WINDOW are merged into one
+gateway member query (up to 100 user ids each); a lone lookup goes over REST
+instead, since the gateway only allows 120 sends a minute per shard and
+member routes have their own per-guild REST buckets. Concurrent lookups for
+the same user share one request. Answers go into a bounded LRU: positive
+answers live for MEMBER_CACHE_TTL, negative ones for the much shorter
+MEMBER_NEGATIVE_TTL so someone who just joined isn't turned away for long.
+
+Guilds this process has no gateway connection for (other cluster processes)
+are checked over REST, one request per user, through the same cache.
+"""
+
+import os
+import asyncio
+
+import discord
+
+from delivery import TTLCache
+
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "20000"))
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "900"))
+MEMBER_NEGATIVE_TTL = float(os.getenv("MEMBER_NEGATIVE_TTL", "60"))
+MEMBER_BATCH_WINDOW = float(os.getenv("MEMBER_BATCH_WINDOW", "0.02"))
+MEMBER_BATCH_SIZE = 100   # Discord's limit on user ids per member query
+
+
+class MemberLookup:
+    def __init__(self, client, cache_size=MEMBER_CACHE_SIZE, positive_ttl=MEMBER_CACHE_TTL,
+                 negative_ttl=MEMBER_NEGATIVE_TTL, batch_window=MEMBER_BATCH_WINDOW):
+        self.client = client
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.batch_window = batch_window
+        self._cache = TTLCache(cache_size, positive_ttl)   # (guild_id, user_id) -> bool
+        self._pending = {}     # guild_id -> {user_id: future} waiting for the next query
+        self._inflight = {}    # (guild_id, user_id) -> future of a query already sent
+        self._tasks = set()
+        self.stats = {"hits": 0, "misses": 0, "queries": 0, "queried_users": 0, "rest_lookups": 0, "failures": 0}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def remember(self, guild_id, user_id, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._cache.set((guild_id, user_id), is_member, ttl)
+
+    def forget_guild(self, guild_id):
+        self._pending.pop(guild_id, None)
+        self._cache.discard(lambda key: key[0] == guild_id)
+
+    async def is_member(self, guild_id, user_id):
+        cached = self._cache.get((guild_id, user_id))
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached
+        self.stats["misses"] += 1
+
+        future = self._inflight.get((guild_id, user_id))
+        if future is None:
+            pending = self._pending.get(guild_id)
+            if pending is None:
+                pending = self._pending[guild_id] = {}
+                task = asyncio.create_task(self._flush_later(guild_id))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            future = pending.get(user_id)
+            if future is None:
+                future = pending[user_id] = asyncio.get_running_loop().create_future()
+        # Several DMs may wait on one answer; don't let one cancellation cancel it for all.
+        return await asyncio.shield(future)
+
+    async def _flush_later(self, guild_id):
+        await asyncio.sleep(self.batch_window)
+        pending = self._pending.pop(guild_id, {})
+        for user_id, future in pending.items():
+            self._inflight[(guild_id, user_id)] = future
+        user_ids = list(pending)
+        for start in range(0, len(user_ids), MEMBER_BATCH_SIZE):
+            batch = {user_id: pending[user_id] for user_id in user_ids[start:start + MEMBER_BATCH_SIZE]}
+            try:
+                found = await self._query(guild_id, list(batch))
+            except Exception as e:
+                self.stats["failures"] += 1
+                print(f"Member lookup in server {guild_id} failed: {e}")
+                found = None
+            for user_id, future in batch.items():
+                self._inflight.pop((guild_id, user_id), None)
+                if found is not None:
+                    self.remember(guild_id, user_id, user_id in found)
+                if not future.done():
+                    # A failed lookup isn't cached, so the next DM asks again.
+                    future.set_result(found is not None and user_id in found)
+
+    async def _query(self, guild_id, user_ids):
+        """Return the subset of user_ids that are members of the guild."""
+        guild = self.client.get_guild(guild_id)
+        if guild is None or len(user_ids) == 1:
+            return {user_id for user_id in user_ids if await self._fetch_member(guild, guild_id, user_id)}
+        self.stats["queries"] += 1
+        self.stats["queried_users"] += len(user_ids)
+        members = await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False)
+        return {member.id for member in members}
+
+    async def _fetch_member(self, guild, guild_id, user_id):
+        self.stats["rest_lookups"] += 1
+        try:
+            if guild is not None:
+                await guild.fetch_member(user_id)
+            else:
+                await self.client.http.get_member(guild_id, user_id)
+            return True
+        except discord.NotFound:
+            return False
+
+    def snapshot(self):
+        return dict(self.stats, cached=len(self._cache), pending_guilds=len(self._pending))
+
+    async def close(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
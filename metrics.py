@@ -0,0 +1,255 @@
+"""
+Lightweight in-process metrics for Whispr.
+
+Counters, gauges and fixed-bucket histograms with Prometheus text
+exposition. Recording a sample is a perf_counter call, a bisect and a couple
+of additions, so instrumentation can stay on in production. When
+METRICS_PORT is set the registry is served at http://METRICS_HOST:METRICS_PORT/metrics.
+"""
+
+import os
+import time
+import logging
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50)
+
+# Per-DM trace: a one-element list counting REST requests made on behalf of
+# the DM currently being handled.
+current_dm = contextvars.ContextVar("whispr_current_dm", default=None)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.callback()}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}     # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def summary(self, **labels):
+        """Count, mean and bucket-estimated p50/p99 for one label set."""
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self.series.get(key)
+        if not series:
+            return None
+        count = sum(series[:-1])
+        return {
+            "count": count,
+            "avg": series[-1] / count,
+            "p50": self._quantile(series, count, 0.50),
+            "p99": self._quantile(series, count, 0.99),
+        }
+
+    def _quantile(self, series, count, q):
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(series[:-1]):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, callback):
+        metric = Gauge(name, help_text, callback)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "whispr_stage_seconds", "Latency of each stage of the DM confession/reply pipeline.", ["stage"]
+)
+dm_seconds = registry.histogram(
+    "whispr_dm_seconds", "End-to-end handling time of a DM until the user is acknowledged.", ["kind"]
+)
+dm_rest_calls = registry.histogram(
+    "whispr_dm_rest_calls", "Discord REST requests made while handling one DM.", ["kind"], COUNT_BUCKETS
+)
+rest_requests = registry.counter(
+    "whispr_rest_requests_total", "Discord REST requests by route.", ["route"]
+)
+discord_rate_limits = registry.counter(
+    "whispr_discord_rate_limited_total", "429 responses reported by discord.py.", ["scope"]
+)
+user_rate_limits = registry.counter(
+    "whispr_user_rate_limited_total", "DMs rejected by Whispr's per-user rate limiter.", ["kind"]
+)
+content_filtered = registry.counter(
+    "whispr_content_filtered_total", "Confessions and replies caught by a server's content filter.", ["action"]
+)
+admission_shed = registry.counter(
+    "whispr_admission_shed_total", "Work turned away because the admission queue was full.", ["kind"]
+)
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+@contextmanager
+def trace_dm(kind):
+    """Time a DM end to end and count the REST requests it makes."""
+    calls = [0]
+    token = current_dm.set(calls)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_dm.reset(token)
+        dm_seconds.observe(time.perf_counter() - started, kind=kind)
+        dm_rest_calls.observe(calls[0], kind=kind)
+
+
+def instrument_http(http):
+    """Count every REST request made through a discord.py HTTPClient."""
+    request = http.request
+
+    async def counted_request(route, **kwargs):
+        rest_requests.inc(route=f"{route.method} {route.path}")
+        calls = current_dm.get()
+        if calls is not None:
+            calls[0] += 1
+        return await request(route, **kwargs)
+
+    http.request = counted_request
+
+
+# discord.py's log formats (discord/http.py). Every 429 is logged with one of
+# the route messages; a global one is logged again with GLOBAL_RATE_LIMIT_MESSAGE
+# straight after, with no await in between.
+ROUTE_RATE_LIMIT_MESSAGES = (
+    "We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.",
+    "We are being rate limited. %s %s responded with 429. Timeout of %.2f was too long, erroring instead.",
+)
+GLOBAL_RATE_LIMIT_MESSAGE = "Global rate limit has been hit. Retrying in %.2f seconds."
+
+
+class RateLimitLogHandler(logging.Handler):
+    """Turns discord.py's 429 warnings into counters, one count per 429."""
+    def emit(self, record):
+        if record.msg in ROUTE_RATE_LIMIT_MESSAGES:
+            discord_rate_limits.inc(scope="route")
+        elif record.msg == GLOBAL_RATE_LIMIT_MESSAGE:
+            # Already counted as a route 429 a moment ago; reclassify it. Both
+            # records are logged synchronously, so no scrape sees it twice.
+            discord_rate_limits.inc(-1, scope="route")
+            discord_rate_limits.inc(scope="global")
+
+
+def install_rate_limit_counter():
+    handler = RateLimitLogHandler(level=logging.WARNING)
+    logging.getLogger("discord.http").addHandler(handler)
+
+
+async def start_http_server(host=METRICS_HOST, port=METRICS_PORT):
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
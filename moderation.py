@@ -0,0 +1,513 @@
+"""
+Screening for incoming confessions and replies.
+
+Near-duplicate detection:
+
+Every confession is reduced to a 64-bit SimHash of its word bigrams, so
+lightly edited copies land within a few bits of each other. Each guild keeps
+a sliding window of recent fingerprints, indexed by banding: the 64 bits are
+cut into 8 bands of 8 bits, and two fingerprints within Hamming distance 7
+must agree on at least one whole band. A lookup therefore only compares
+against the handful of fingerprints sharing a band, which keeps a check well
+under a millisecond, and the window is capped per guild so memory stays
+bounded however many copies a raid sends.
+
+Fingerprints use Python's per-process string hash; they are never persisted.
+
+Content filter: each guild's blocked words and phrases are compiled into one
+Aho-Corasick automaton and its regex rules into one alternation per action,
+and both are rebuilt only when the guild's rules change. Screening a message
+is then one pass over the text per automaton, however many rules there are.
+A rule rejects, holds or masks what it matches; the strongest action wins.
+An alternation only reports non-overlapping matches, so the regex rules are
+searched reject first, then hold, then mask, and a weaker rule can't hide a
+stronger one matching the same text.
+
+Regex rules run in a worker process, never on the event loop. Python's re
+can backtrack exponentially, can't be interrupted and holds the GIL while it
+does, so a scan that overruns PATTERN_SCAN_TIMEOUT kills the worker (a new
+one starts on the next scan) and the message is held for review instead.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+from collections import deque
+
+DUPLICATE_INDEX_SIZE = int(os.getenv("DUPLICATE_INDEX_SIZE", "1000"))
+MAX_FILTER_WORDS = int(os.getenv("MAX_FILTER_WORDS", "1000"))
+MAX_FILTER_PATTERNS = int(os.getenv("MAX_FILTER_PATTERNS", "50"))
+MAX_PATTERN_LENGTH = 200
+# A pattern that takes longer than this on the probe texts is refused up front;
+# the worker timeout below is what actually protects the bot.
+PATTERN_PROBE_BUDGET = 0.02
+PATTERN_SCAN_TIMEOUT = float(os.getenv("PATTERN_SCAN_TIMEOUT", "0.25"))
+PATTERN_WORKER_LINE_LIMIT = 2 ** 20
+
+DUPLICATE_ACTIONS = ("off", "reject", "hold")
+DEFAULT_DUPLICATE_POLICY = {"action": "reject", "distance": 6, "window": 600}
+BANDS = 8
+BAND_BITS = 64 // BANDS
+MAX_DISTANCE = BANDS - 1
+# Very short messages ("hi", "help") are too generic to call copies.
+MIN_TOKENS = 4
+# Copies are recognisable from their opening; this bounds the cost of a check.
+MAX_TOKENS = 200
+
+_TOKEN = re.compile(r"\w+")
+_MASK = (1 << 64) - 1
+_LANE_BITS = 16   # per-bit counters, wide enough for MAX_TOKENS shingles
+# _SPREAD[b] places bit j of byte b in counter lane j.
+_SPREAD = [sum(((b >> j) & 1) << (j * _LANE_BITS) for j in range(8)) for b in range(256)]
+
+
+def simhash(text):
+    """64-bit SimHash of the text's word bigrams, or None if it is too short."""
+    tokens = _TOKEN.findall(text.lower())[:MAX_TOKENS]
+    if len(tokens) < MIN_TOKENS:
+        return None
+    shingles = {(tokens[i], tokens[i + 1]) for i in range(len(tokens) - 1)}
+
+    # Sum every shingle hash into 64 16-bit counters at once: one big-int
+    # addition per shingle instead of 64 bit tests.
+    counters = 0
+    for shingle in shingles:
+        h = hash(shingle) & _MASK
+        for k in range(8):
+            counters += _SPREAD[(h >> (8 * k)) & 0xFF] << (k * 8 * _LANE_BITS)
+
+    half = len(shingles) / 2
+    lane_mask = (1 << _LANE_BITS) - 1
+    fingerprint = 0
+    for bit in range(64):
+        if ((counters >> (bit * _LANE_BITS)) & lane_mask) > half:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def _bands(fingerprint):
+    band_mask = (1 << BAND_BITS) - 1
+    return [(band, (fingerprint >> (band * BAND_BITS)) & band_mask) for band in range(BANDS)]
+
+
+class SimilarityIndex:
+    """Sliding window of recent fingerprints for one guild."""
+    def __init__(self, max_entries=DUPLICATE_INDEX_SIZE):
+        self.max_entries = max_entries
+        self._entries = deque()   # (seen_at, fingerprint), oldest first
+        self._buckets = {}        # (band, band value) -> {fingerprint: seen_at}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, cutoff):
+        while self._entries and (self._entries[0][0] <= cutoff or len(self._entries) > self.max_entries):
+            seen_at, fingerprint = self._entries.popleft()
+            for key in _bands(fingerprint):
+                bucket = self._buckets.get(key)
+                # Only drop the bucket entry if a newer copy didn't refresh it.
+                if bucket is not None and bucket.get(fingerprint) == seen_at:
+                    del bucket[fingerprint]
+                    if not bucket:
+                        del self._buckets[key]
+
+    def find(self, fingerprint, distance, window, now=None):
+        """Return the age in seconds of the closest recent match, or None."""
+        now = time.time() if now is None else now
+        self._evict(now - window)
+        best = None
+        for key in _bands(fingerprint):
+            for candidate, seen_at in self._buckets.get(key, {}).items():
+                if bin(candidate ^ fingerprint).count("1") <= distance:
+                    if best is None or seen_at > best:
+                        best = seen_at
+        return None if best is None else now - best
+
+    def add(self, fingerprint, now=None):
+        now = time.time() if now is None else now
+        self._entries.append((now, fingerprint))
+        for key in _bands(fingerprint):
+            self._buckets.setdefault(key, {})[fingerprint] = now
+        if len(self._entries) > self.max_entries:
+            self._evict(float("-inf"))
+
+
+class DuplicateFilter:
+    def __init__(self, max_entries=DUPLICATE_INDEX_SIZE):
+        self.max_entries = max_entries
+        self._indexes = {}   # guild_id -> SimilarityIndex
+        self.stats = {"checked": 0, "rejected": 0, "held": 0}
+
+    def check(self, guild_id, content, policy):
+        """Returns (action, fingerprint). action is "allow", "reject" or "hold".
+
+        The fingerprint is None when the content is too short to compare;
+        call remember() with it once the confession is posted or held.
+        """
+        if policy["action"] == "off":
+            return "allow", None
+        fingerprint = simhash(content)
+        if fingerprint is None:
+            return "allow", None
+        self.stats["checked"] += 1
+        index = self._indexes.get(guild_id)
+        if index is None:
+            index = self._indexes[guild_id] = SimilarityIndex(self.max_entries)
+        if index.find(fingerprint, policy["distance"], policy["window"]) is None:
+            return "allow", fingerprint
+        action = policy["action"]
+        self.stats["rejected" if action == "reject" else "held"] += 1
+        return action, fingerprint
+
+    def remember(self, guild_id, fingerprint):
+        if fingerprint is None:
+            return
+        index = self._indexes.get(guild_id)
+        if index is None:
+            index = self._indexes[guild_id] = SimilarityIndex(self.max_entries)
+        index.add(fingerprint)
+
+    def forget_guild(self, guild_id):
+        self._indexes.pop(guild_id, None)
+
+    def snapshot(self):
+        return dict(self.stats, indexed=sum(len(index) for index in self._indexes.values()))
+
+
+FILTER_ACTIONS = ("reject", "hold", "mask")
+_ACTION_RANK = {"allow": 0, "mask": 1, "hold": 2, "reject": 3}
+MASK_CHAR = "█"
+# Probe texts grow step by step so a pattern with exponential or polynomial
+# backtracking is caught at the first slow step instead of hanging the check.
+_PROBE_UNITS = ("a", "1", " ", "ab", "a ", "1 ")
+_PROBE_LENGTHS = tuple(range(4, 34, 2)) + (64, 128, 256, 512, 1024, 2048)
+
+
+def _lower(text):
+    """Lowercase without changing the length, so match offsets index the original text."""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+
+def normalize_word(word):
+    return " ".join(_lower(word).split())
+
+
+def combine_patterns(patterns):
+    """One alternation with a named group per rule, so a match tells which rule it was.
+
+    patterns maps each rule's index to its pattern; the index names the group.
+    """
+    return re.compile("|".join(f"(?P<r{i}>{pattern})" for i, pattern in patterns.items()), re.IGNORECASE)
+
+
+def validate_pattern(pattern):
+    """Return why a regex rule can't be used, or None if it can."""
+    if not isinstance(pattern, str) or not pattern:
+        return "the pattern is empty"
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        return f"patterns are limited to {MAX_PATTERN_LENGTH} characters"
+    # Rules are combined into one alternation, which renumbers groups.
+    if re.search(r"\\[1-9]|\(\?P[<=]", pattern):
+        return "backreferences and named groups aren't supported"
+    # Global flags like (?i) are only allowed at the very start of the combined
+    # expression; scoped ones like (?i:...) are fine.
+    if re.search(r"\(\?[aiLmsux]+\)", pattern):
+        return "global flags like `(?i)` aren't supported; use `(?i:...)` (rules already ignore case)"
+    try:
+        regex = re.compile(pattern, re.IGNORECASE)
+        # Compile it the way CompiledRules will, as one group of the alternation.
+        combine_patterns({0: pattern})
+    except re.error as e:
+        return f"invalid regex: {e}"
+    if regex.search(""):
+        return "the pattern matches empty text"
+    for unit in _PROBE_UNITS:
+        for length in _PROBE_LENGTHS:
+            started = time.perf_counter()
+            regex.search(unit * length + "!")
+            if time.perf_counter() - started > PATTERN_PROBE_BUDGET:
+                return "the pattern is too slow to run on every message"
+    return None
+
+
+class WordAutomaton:
+    """Aho-Corasick automaton over a fixed set of lowercase words and phrases."""
+    def __init__(self, words):
+        self._goto = [{}]     # node -> {char: node}
+        self._fail = [0]
+        self._out = [()]      # node -> indexes of the words ending here
+        self._lengths = [len(word) for word in words]
+        for index, word in enumerate(words):
+            node = 0
+            for char in word:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = self._goto[node][char] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += (index,)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child] += self._out[self._fail[child]]
+
+    def finditer(self, text):
+        """Yield (start, end, word index) for every occurrence, in one pass.
+
+        A run of whitespace in the text matches a single space in a phrase.
+        """
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self._lengths
+        node = 0
+        offsets = []   # offset in text of each character fed to the automaton
+        in_space = False
+        for position, char in enumerate(text):
+            if char.isspace():
+                if in_space:
+                    continue
+                char = " "
+                in_space = True
+            else:
+                in_space = False
+            offsets.append(position)
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in out[node]:
+                yield offsets[len(offsets) - lengths[index]], position + 1, index
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+def compile_pattern_rules(patterns):
+    """Return [(action, combined regex)] for [[pattern, action], ...], strongest action first."""
+    compiled = []
+    for action in FILTER_ACTIONS:
+        indexed = {i: pattern for i, (pattern, rule_action) in enumerate(patterns) if rule_action == action}
+        if indexed:
+            compiled.append((action, combine_patterns(indexed)))
+    return compiled
+
+
+def scan_pattern_rules(compiled, text):
+    """Return [[group, start, end], ...] for compile_pattern_rules' output.
+
+    The first reject match ends the scan. A hold stops the search for more
+    holds, but mask rules still run so a held message is shown masked.
+    """
+    matches = []
+    for action, regex in compiled:
+        for match in regex.finditer(text):
+            if match.end() == match.start():
+                continue
+            matches.append([match.lastgroup, match.start(), match.end()])
+            if action != "mask":
+                break
+        if matches and action == "reject":
+            break
+    return matches
+
+
+def run_pattern_worker(stdin=sys.stdin, stdout=sys.stdout):
+    """Worker process loop, one JSON line each way: {"guild_id", "patterns" or null, "text"}
+    in, [[group, start, end], ...] out. Patterns are [[pattern, action], ...] and are
+    only sent when they change."""
+    compiled = {}   # guild_id -> compile_pattern_rules of that guild's current patterns
+    for line in stdin:
+        request = json.loads(line)
+        if request["patterns"] is not None:
+            compiled[request["guild_id"]] = compile_pattern_rules(request["patterns"])
+        matches = scan_pattern_rules(compiled[request["guild_id"]], request["text"])
+        stdout.write(json.dumps(matches) + "\n")
+        stdout.flush()
+
+
+class PatternScanner:
+    """Runs regex rules in a worker process that is killed when a scan overruns its timeout."""
+    def __init__(self, timeout=PATTERN_SCAN_TIMEOUT):
+        self.timeout = timeout
+        self._process = None
+        self._loaded = {}    # guild_id -> patterns the worker has compiled for it
+        self._lock = asyncio.Lock()
+        self.stats = {"scans": 0, "timeouts": 0, "failures": 0, "restarts": 0}
+
+    async def _start(self):
+        self._process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=PATTERN_WORKER_LINE_LIMIT,
+        )
+        self._loaded = {}
+        self.stats["restarts"] += 1
+
+    async def _stop(self):
+        process, self._process = self._process, None
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    async def scan(self, guild_id, patterns, text):
+        """Return the (group, start, end) of each match, or None if the scan failed or timed out."""
+        async with self._lock:
+            self.stats["scans"] += 1
+            try:
+                if self._process is None or self._process.returncode is not None:
+                    await self._stop()
+                    await self._start()
+                request = {
+                    "guild_id": guild_id,
+                    "patterns": patterns if self._loaded.get(guild_id) != patterns else None,
+                    "text": text,
+                }
+                self._process.stdin.write(json.dumps(request).encode() + b"\n")
+                await self._process.stdin.drain()
+                line = await asyncio.wait_for(self._process.stdout.readline(), self.timeout)
+                if not line:
+                    raise EOFError("the worker exited")
+                matches = json.loads(line)
+                self._loaded[guild_id] = patterns
+                return matches
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                print(f"Regex rules of server {guild_id} overran {self.timeout:g}s; restarting the worker")
+                await self._stop()
+                return None
+            except (EOFError, OSError, ValueError) as e:
+                self.stats["failures"] += 1
+                print(f"Regex rule worker failed: {e}")
+                await self._stop()
+                return None
+            except BaseException:
+                # A cancelled exchange would leave its answer in the pipe for the next caller.
+                if self._process is not None:
+                    self._process.kill()
+                    self._process = None
+                raise
+
+    def forget_guild(self, guild_id):
+        self._loaded.pop(guild_id, None)
+
+    async def close(self):
+        await self._stop()
+
+
+class CompiledRules:
+    def __init__(self, rules):
+        words = list(rules.get("words", {}))
+        self._word_actions = [rules["words"][word] for word in words]
+        self._automaton = WordAutomaton(words) if words else None
+        # Rules are checked when added, but skip anything that still doesn't
+        # compile on its own rather than breaking every scan for the guild.
+        self.patterns = []    # [[pattern, action], ...] as the worker takes them
+        for pattern, action in rules.get("patterns", {}).items():
+            try:
+                combine_patterns({0: pattern})
+            except re.error as e:
+                print(f"Skipping content filter rule {pattern!r}: {e}")
+                continue
+            self.patterns.append([pattern, action])
+        self._pattern_actions = {f"r{i}": action for i, (pattern, action) in enumerate(self.patterns)}
+
+    def scan_words(self, text):
+        """Return (action, spans): the strongest word action matched and the spans of "mask" matches."""
+        action = "allow"
+        spans = []
+        if self._automaton is not None:
+            lowered = _lower(text)
+            for start, end, index in self._automaton.finditer(lowered):
+                # Whole words only, so a blocked word doesn't catch longer words containing it.
+                if (start > 0 and _is_word_char(lowered[start - 1])) or (end < len(lowered) and _is_word_char(lowered[end])):
+                    continue
+                matched = self._word_actions[index]
+                if matched == "reject":
+                    return "reject", []
+                if matched == "mask":
+                    spans.append((start, end))
+                if _ACTION_RANK[matched] > _ACTION_RANK[action]:
+                    action = matched
+        return action, spans
+
+    def apply_pattern_matches(self, matches, action, spans):
+        """Fold the worker's regex matches into (action, spans) from scan_words."""
+        for group, start, end in matches:
+            matched = self._pattern_actions[group]
+            if matched == "reject":
+                return "reject", []
+            if matched == "mask":
+                spans.append((start, end))
+            if _ACTION_RANK[matched] > _ACTION_RANK[action]:
+                action = matched
+        return action, spans
+
+
+def mask_spans(text, spans):
+    chars = list(text)
+    for start, end in spans:
+        for i in range(start, end):
+            if not chars[i].isspace():
+                chars[i] = MASK_CHAR
+    return "".join(chars)
+
+
+class ContentFilter:
+    """Per-guild word and regex rules, compiled once per rules version."""
+    def __init__(self, scanner=None):
+        self._compiled = {}   # guild_id -> (rules version, CompiledRules)
+        self.scanner = scanner or PatternScanner()
+        self.stats = {"checked": 0, "rejected": 0, "held": 0, "masked": 0}
+
+    async def check(self, guild_id, content, rules):
+        """Returns (action, content). action is "allow", "reject", "hold" or "mask".
+
+        Masked spans are blanked out of the returned content for "mask", and
+        for "hold" too when the held message also matched a mask rule.
+        """
+        if not rules or not (rules.get("words") or rules.get("patterns")):
+            return "allow", content
+        entry = self._compiled.get(guild_id)
+        if entry is None or entry[0] != rules["version"]:
+            entry = self._compiled[guild_id] = (rules["version"], CompiledRules(rules))
+        self.stats["checked"] += 1
+        compiled = entry[1]
+        action, spans = compiled.scan_words(content)
+        if action != "reject" and compiled.patterns:
+            matches = await self.scanner.scan(guild_id, compiled.patterns, content)
+            if matches is None:
+                # The regex rules couldn't be checked; let a moderator decide.
+                action = "hold"
+            else:
+                action, spans = compiled.apply_pattern_matches(matches, action, spans)
+        if spans:
+            content = mask_spans(content, spans)
+        if action != "allow":
+            self.stats[{"reject": "rejected", "hold": "held", "mask": "masked"}[action]] += 1
+        return action, content
+
+    def forget_guild(self, guild_id):
+        self._compiled.pop(guild_id, None)
+        self.scanner.forget_guild(guild_id)
+
+    def snapshot(self):
+        return dict(self.stats, compiled_guilds=len(self._compiled), pattern_timeouts=self.scanner.stats["timeouts"])
+
+    async def close(self):
+        await self.scanner.close()
+
+
+if __name__ == "__main__":
+    run_pattern_worker()
@@ -0,0 +1,118 @@
+"""
+Token-bucket rate limiting with automatic expiry.
+
+Each (kind, user, guild) key owns a small token bucket. Once a bucket has
+refilled completely it carries no information, so it is dropped: buckets are
+filed on a timing wheel under the second they become full, and every call
+sweeps the slots that have passed. Memory is therefore proportional to the
+users who are still inside their window.
+
+Time is wall-clock so a snapshot taken before a restart stays meaningful
+after it.
+"""
+
+import os
+import json
+import time
+import tempfile
+
+DEFAULT_POLICIES = {
+    "confessions": (1, 30),
+    "replies": (3, 30),
+}
+WHEEL_RESOLUTION = 1.0
+
+
+class RateLimiter:
+    def __init__(self, resolution=WHEEL_RESOLUTION):
+        self.resolution = resolution
+        self._buckets = {}   # key -> [tokens, updated_at, expiry_slot]
+        self._wheel = {}     # slot -> set of keys expiring in it
+        self._swept = int(time.time() / resolution)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _sweep(self, now):
+        current = int(now / self.resolution)
+        if current <= self._swept:
+            return
+        if current - self._swept > len(self._wheel):
+            # Idle for a long time: cheaper to visit the occupied slots.
+            slots = [slot for slot in self._wheel if slot <= current]
+        else:
+            slots = range(self._swept + 1, current + 1)
+        for slot in slots:
+            for key in self._wheel.pop(slot, ()):
+                bucket = self._buckets.get(key)
+                if bucket is not None and bucket[2] == slot:
+                    del self._buckets[key]
+        self._swept = current
+
+    def _file(self, key, bucket, limit, per):
+        full_at = bucket[1] + (limit - bucket[0]) * per / limit
+        slot = int(full_at / self.resolution) + 1
+        if bucket[2] != slot:
+            old = self._wheel.get(bucket[2])
+            if old is not None:
+                old.discard(key)
+                if not old:
+                    del self._wheel[bucket[2]]
+            self._wheel.setdefault(slot, set()).add(key)
+            bucket[2] = slot
+
+    def hit(self, key, limit, per, now=None):
+        """Take one token for key. Returns (allowed, retry_after_seconds)."""
+        now = time.time() if now is None else now
+        self._sweep(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(limit), now, None]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / per)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self._file(key, bucket, limit, per)
+            return True, 0.0
+        self._file(key, bucket, limit, per)
+        return False, (1 - bucket[0]) * per / limit
+
+    def snapshot(self):
+        return [[list(key), tokens, updated, slot] for key, (tokens, updated, slot) in self._buckets.items()]
+
+    def restore(self, entries, now=None):
+        now = time.time() if now is None else now
+        self._swept = int(now / self.resolution)
+        for key, tokens, updated, slot in entries:
+            if slot <= self._swept:
+                continue
+            key = tuple(key)
+            self._buckets[key] = [tokens, updated, slot]
+            self._wheel.setdefault(slot, set()).add(key)
+
+
+def save_snapshot(limiter_entries, path):
+    # A temp file of our own, so two writers can never interleave into one file.
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"saved_at": time.time(), "buckets": limiter_entries}, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_snapshot(path):
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r") as f:
+            return json.load(f).get("buckets", [])
+    except (OSError, ValueError, AttributeError) as e:
+        # A lost snapshot only means fresh allowances; it mustn't stop the bot starting.
+        print(f"Ignoring unreadable rate limit snapshot {path}: {e}")
+        return []
@@ -0,0 +1,516 @@
+"""
+In-memory bot state with write-behind persistence.
+
+BotState is the source of truth while the bot runs. Handlers read and mutate
+plain dicts; every mutation only marks the touched key dirty. A background
+task flushes dirty keys to the storage backend in batches, on a fixed
+interval or as soon as too many keys are dirty, and the actual disk writes
+run in a dedicated executor thread so the event loop never blocks on I/O.
+
+Drafts are DMs waiting for the user to pick a server. They live in a small
+bounded store with a TTL and a small per-user cap, and are persisted like everything
+else so a server picker keeps working across a restart.
+
+Confessions and replies held for review are the exception to write-behind:
+they are written straight through, because the author is told their message
+is held as soon as it is stored, and in cluster mode the admins reviewing it
+may be served by another process.
+
+Only recent confessions are kept in memory (CONFESSION_CACHE_DAYS); older
+ones are read from storage on demand. A background compaction pass applies
+each guild's retention settings in small batches: it unlinks old confessions
+from their authors and drops old text from the search index.
+
+export_guild and import_guild stream one guild's data to and from a file
+(see transfer.py) a batch at a time, with the storage side of every batch
+on the flush executor like any other write.
+
+With shared=True (cluster mode) several processes use the same SQLite
+database: each one publishes the membership of the configured guilds it
+serves, and periodically re-reads the guild directory written by the others.
+"""
+
+import os
+import time
+import asyncio
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from transfer import TRANSFER_BATCH
+
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2.0"))
+STATE_MAX_DIRTY = int(os.getenv("STATE_MAX_DIRTY", "500"))
+CODE_BLOCK_SIZE = int(os.getenv("CODE_BLOCK_SIZE", "100"))
+CLUSTER_SYNC_INTERVAL = float(os.getenv("CLUSTER_SYNC_INTERVAL", "5.0"))
+DRAFT_TTL = float(os.getenv("DRAFT_TTL", "600"))
+DRAFT_MAX = int(os.getenv("DRAFT_MAX", "10000"))
+DRAFTS_PER_USER = 5
+CONFESSION_CACHE_DAYS = float(os.getenv("CONFESSION_CACHE_DAYS", "30"))
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "300"))
+COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", "500"))
+HOLD_QUEUE_SIZE = int(os.getenv("HOLD_QUEUE_SIZE", "100"))
+DAY = 86400
+
+
+class BotState:
+    def __init__(self, storage=None, flush_interval=STATE_FLUSH_INTERVAL, max_dirty=STATE_MAX_DIRTY,
+                 code_block_size=CODE_BLOCK_SIZE, shared=False, sync_interval=CLUSTER_SYNC_INTERVAL,
+                 draft_ttl=DRAFT_TTL, draft_max=DRAFT_MAX, cache_days=CONFESSION_CACHE_DAYS,
+                 compaction_interval=COMPACTION_INTERVAL, compaction_batch=COMPACTION_BATCH,
+                 transfer_batch=TRANSFER_BATCH, hold_limit=HOLD_QUEUE_SIZE):
+        self.storage = storage
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.code_block_size = code_block_size
+        self.draft_ttl = draft_ttl
+        self.draft_max = draft_max
+        self.cache_days = cache_days
+        self.compaction_interval = compaction_interval
+        self.compaction_batch = compaction_batch
+        self.transfer_batch = transfer_batch
+        self.hold_limit = hold_limit
+
+        self.guild_map = {}      # guild_id -> confession channel id
+        self.confessions = {}    # (guild_id, code) -> confession record, recent ones only
+        self.guild_names = {}    # guild_id -> name, for guilds served by other processes
+        self.guild_settings = {} # guild_id -> {setting: JSON-serialisable value}
+        self.drafts = {}         # draft_id -> pending DM, oldest first
+        self._user_drafts = {}   # user_id -> that user's draft ids, oldest first
+
+        # Confession numbers are handed out from blocks reserved durably in
+        # storage; only the block's high-water mark is ever persisted.
+        self._next_code = {}     # guild_id -> next number to hand out
+        self._code_limit = {}    # guild_id -> end of the reserved block
+        self._code_locks = {}    # guild_id -> asyncio.Lock
+
+        self._dirty_guilds = set()
+        self._dirty_confessions = set()
+        self._dirty_settings = set()
+        self._dirty_drafts = set()
+        self._member_ops = []
+        self._search_docs = []   # confession/reply text waiting to be indexed
+        self._wake = asyncio.Event()
+        self._task = None
+        self._sync_task = None
+        self._compaction_task = None
+        self._search_watermark = {}   # guild_id -> search rowid pruned up to
+        self.compaction_report = None
+        self.compaction_totals = {"passes": 0, "authors_unlinked": 0, "search_pruned": 0, "evicted": 0}
+        # A single worker keeps writes ordered and the backend single-threaded.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whispr-flush")
+
+    def load(self, storage=None):
+        """Load the persisted snapshot. The backend may be handed over here
+        rather than to the constructor, so creating a BotState does no I/O."""
+        if storage is not None:
+            self.storage = storage
+        self.searchable = hasattr(self.storage, "search")
+        self.retainable = hasattr(self.storage, "expire_authors")
+        snapshot = self.storage.load_snapshot(since=time.time() - self.cache_days * DAY)
+        self.guild_map = snapshot["guilds"]
+        self.confessions = snapshot["confessions"]
+        self.guild_settings = snapshot["settings"]
+        now = time.time()
+        for draft_id, draft in sorted(snapshot["drafts"].items(), key=lambda item: item[1]["expires_at"]):
+            if draft["expires_at"] > now:
+                self.drafts[draft_id] = draft
+                self._user_drafts.setdefault(draft["user_id"], []).append(draft_id)
+        if self.shared:
+            for guild_id, (channel_id, name) in self.storage.load_guild_directory().items():
+                if name is not None:
+                    self.guild_names[guild_id] = name
+
+    @property
+    def dirty_count(self):
+        return (len(self._dirty_guilds) + len(self._dirty_confessions)
+                + len(self._dirty_settings) + len(self._dirty_drafts) + len(self._member_ops)
+                + len(self._search_docs))
+
+    def _mark_dirty(self):
+        if self.dirty_count >= self.max_dirty:
+            self._wake.set()
+
+    def set_guild_channel(self, guild_id, channel_id):
+        self.guild_map[guild_id] = channel_id
+        self._dirty_guilds.add(guild_id)
+        self._mark_dirty()
+
+    def get_guild_setting(self, guild_id, key, default=None):
+        return self.guild_settings.get(guild_id, {}).get(key, default)
+
+    def set_guild_setting(self, guild_id, key, value):
+        self.guild_settings.setdefault(guild_id, {})[key] = value
+        self._dirty_settings.add((guild_id, key))
+        self._mark_dirty()
+
+    async def allocate_confession_code(self, guild_id):
+        lock = self._code_locks.get(guild_id)
+        if lock is None:
+            lock = self._code_locks[guild_id] = asyncio.Lock()
+        async with lock:
+            num = self._next_code.get(guild_id)
+            if num is None or num >= self._code_limit[guild_id]:
+                # Reserve the next block before handing out any of it. After
+                # a crash the unused rest of the block is skipped, never reused.
+                loop = asyncio.get_running_loop()
+                num = await loop.run_in_executor(
+                    self._executor, self.storage.reserve_codes, guild_id, self.code_block_size
+                )
+                self._code_limit[guild_id] = num + self.code_block_size
+            self._next_code[guild_id] = num + 1
+            return num
+
+    def record_confession(self, guild_id, code, author_id, channel_id, message_id, created_at):
+        self.confessions[(guild_id, code)] = {
+            "author_id": author_id,
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "created_at": created_at,
+        }
+        self._dirty_confessions.add((guild_id, code))
+        self._mark_dirty()
+
+    def index_text(self, guild_id, kind, code, content, channel_id, message_id, created_at):
+        """Queue posted text for the search index; written with the next flush."""
+        if not self.searchable:
+            return
+        self._search_docs.append({
+            "guild_id": guild_id,
+            "kind": kind,
+            "code": code,
+            "content": content,
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "created_at": created_at,
+        })
+        self._mark_dirty()
+
+    async def search(self, guild_id, terms, limit, offset=0):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.storage.search, guild_id, terms, limit, offset)
+
+    def get_confession(self, guild_id, code):
+        return self.confessions.get((guild_id, code))
+
+    async def fetch_confession(self, guild_id, code):
+        confession = self.confessions.get((guild_id, code))
+        if confession is None:
+            # Older than the cache, or posted by another cluster process
+            # since our snapshot.
+            loop = asyncio.get_running_loop()
+            confession = await loop.run_in_executor(self._executor, self.storage.get_confession, guild_id, code)
+            if confession is not None:
+                self.confessions[(guild_id, code)] = confession
+        return confession
+
+    def create_draft(self, user_id, kind, content, code=None):
+        """Park a DM until the user picks a server; returns its id.
+
+        Past DRAFTS_PER_USER pending drafts a user's oldest one is dropped,
+        and its picker then reports it as expired.
+        """
+        self._expire_drafts()
+        user_drafts = self._user_drafts.get(user_id, ())
+        while len(user_drafts) >= DRAFTS_PER_USER:
+            self._drop_draft(user_drafts[0])
+        while len(self.drafts) >= self.draft_max:
+            self._drop_draft(next(iter(self.drafts)))
+        draft_id = secrets.randbits(48)
+        self.drafts[draft_id] = {
+            "user_id": user_id,
+            "kind": kind,
+            "code": code,
+            "content": content,
+            "expires_at": time.time() + self.draft_ttl,
+        }
+        self._user_drafts.setdefault(user_id, []).append(draft_id)
+        self._dirty_drafts.add(draft_id)
+        self._mark_dirty()
+        return draft_id
+
+    def get_draft(self, draft_id):
+        draft = self.drafts.get(draft_id)
+        if draft is None or draft["expires_at"] <= time.time():
+            return None
+        return draft
+
+    def pop_draft(self, draft_id):
+        """Take a draft out of the store so it can only be posted once."""
+        draft = self.get_draft(draft_id)
+        if draft is not None:
+            self._drop_draft(draft_id)
+        return draft
+
+    def restore_draft(self, draft_id, draft):
+        """Put back a draft that was taken but not posted, unless it has expired since."""
+        if draft["expires_at"] <= time.time() or draft_id in self.drafts:
+            return
+        self.drafts[draft_id] = draft
+        self._user_drafts.setdefault(draft["user_id"], []).append(draft_id)
+        self._dirty_drafts.add(draft_id)
+        self._mark_dirty()
+
+    def _drop_draft(self, draft_id):
+        draft = self.drafts.pop(draft_id, None)
+        if draft is None:
+            return
+        user_drafts = self._user_drafts[draft["user_id"]]
+        user_drafts.remove(draft_id)
+        if not user_drafts:
+            del self._user_drafts[draft["user_id"]]
+        self._dirty_drafts.add(draft_id)
+        self._mark_dirty()
+
+    def _expire_drafts(self):
+        # Every draft gets the same TTL, so insertion order is expiry order.
+        now = time.time()
+        while self.drafts:
+            draft_id = next(iter(self.drafts))
+            if self.drafts[draft_id]["expires_at"] > now:
+                break
+            self._drop_draft(draft_id)
+
+    def publish_guild_members(self, guild_id, name, member_ids):
+        """Replace the shared member list of a guild this process serves."""
+        if self.shared:
+            self._member_ops.append(("replace", guild_id, name, member_ids))
+            self._mark_dirty()
+
+    def publish_member(self, guild_id, user_id, joined):
+        if self.shared:
+            self._member_ops.append(("add" if joined else "remove", guild_id, user_id))
+            self._mark_dirty()
+
+    async def fetch_member_guild_ids(self, user_id):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.storage.get_member_guild_ids, user_id)
+
+    async def refresh_shared(self):
+        loop = asyncio.get_running_loop()
+        directory = await loop.run_in_executor(self._executor, self.storage.load_guild_directory)
+        for guild_id, (channel_id, name) in directory.items():
+            # Local unflushed changes win over what's on disk.
+            if guild_id not in self._dirty_guilds:
+                self.guild_map[guild_id] = channel_id
+            if name is not None:
+                self.guild_names[guild_id] = name
+        settings = await loop.run_in_executor(self._executor, self.storage.load_guild_settings)
+        for guild_id, values in settings.items():
+            for key, value in values.items():
+                if (guild_id, key) not in self._dirty_settings:
+                    self.guild_settings.setdefault(guild_id, {})[key] = value
+
+    async def add_hold(self, guild_id, author_id, content, reason, kind="confession", code=None):
+        """Store a confession or reply for moderator review; returns its hold id."""
+        hold = {
+            "kind": kind, "code": code, "author_id": author_id,
+            "content": content, "reason": reason, "held_at": time.time(),
+        }
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.storage.add_hold, guild_id, hold, self.hold_limit)
+
+    async def list_holds(self, guild_id, limit):
+        """(total, oldest limit holds as [(hold_id, hold), ...])"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.storage.list_holds, guild_id, limit)
+
+    async def pop_hold(self, guild_id, hold_id):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.storage.pop_hold, guild_id, hold_id)
+
+    def get_retention(self, guild_id):
+        """{"author_days": days or None, "content_days": days or None}"""
+        return dict({"author_days": None, "content_days": None}, **self.get_guild_setting(guild_id, "retention", {}))
+
+    async def compact(self):
+        """One compaction pass. Storage work runs in batches on the flush
+        executor, so writes stay ordered and the event loop keeps serving."""
+        started = time.perf_counter()
+        now = time.time()
+        loop = asyncio.get_running_loop()
+        report = {"started_at": now, "guilds": 0, "batches": 0, "authors_unlinked": 0, "search_pruned": 0, "evicted": 0}
+
+        author_cutoffs = {}
+        if self.retainable:
+            for guild_id in list(self.guild_settings):
+                retention = self.get_retention(guild_id)
+                if not (retention["author_days"] or retention["content_days"]):
+                    continue
+                report["guilds"] += 1
+                if retention["author_days"]:
+                    before = author_cutoffs[guild_id] = now - retention["author_days"] * DAY
+                    while True:
+                        unlinked = await loop.run_in_executor(
+                            self._executor, self.storage.expire_authors, guild_id, before, self.compaction_batch
+                        )
+                        report["batches"] += 1
+                        report["authors_unlinked"] += unlinked
+                        if unlinked < self.compaction_batch:
+                            break
+                if retention["content_days"] and self.searchable:
+                    before = now - retention["content_days"] * DAY
+                    done = False
+                    while not done:
+                        pruned, self._search_watermark[guild_id], done = await loop.run_in_executor(
+                            self._executor, self.storage.prune_search, guild_id, before,
+                            self._search_watermark.get(guild_id, 0), self.compaction_batch
+                        )
+                        report["batches"] += 1
+                        report["search_pruned"] += pruned
+
+        # Keep the cached copies in line with storage, and drop confessions
+        # that have aged out of the cache.
+        cache_cutoff = now - self.cache_days * DAY
+        stale = []
+        for key, confession in self.confessions.items():
+            created_at = confession["created_at"]
+            if created_at is None:
+                continue
+            if key[0] in author_cutoffs and created_at < author_cutoffs[key[0]]:
+                confession["author_id"] = None
+            if created_at < cache_cutoff and key not in self._dirty_confessions:
+                stale.append(key)
+        for key in stale:
+            del self.confessions[key]
+        report["evicted"] = len(stale)
+
+        report["duration"] = time.perf_counter() - started
+        self.compaction_report = report
+        self.compaction_totals["passes"] += 1
+        for key in ("authors_unlinked", "search_pruned", "evicted"):
+            self.compaction_totals[key] += report[key]
+        return report
+
+    async def export_guild(self, guild_id, writer):
+        """Write a guild's configuration and confessions to an ExportWriter; returns the confession count."""
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        config = await loop.run_in_executor(self._executor, self.storage.export_guild_config, guild_id)
+        await loop.run_in_executor(None, writer.write_config, config)
+        exported = after_code = 0
+        while True:
+            page = await loop.run_in_executor(
+                self._executor, self.storage.export_confessions, guild_id, after_code, self.transfer_batch
+            )
+            if page:
+                await loop.run_in_executor(None, writer.write_confessions, page)
+                exported += len(page)
+                after_code = page[-1]["code"]
+            if len(page) < self.transfer_batch:
+                return exported
+
+    async def import_guild(self, guild_id, reader):
+        """Import an ImportReader's records into a guild without overwriting anything it already has."""
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        totals = {"confessions": 0, "existing": 0, "settings": 0, "channel": False, "batches": 0}
+        while True:
+            records = await loop.run_in_executor(None, reader.next_batch)
+            if not records:
+                return totals
+            report = await loop.run_in_executor(self._executor, self.storage.import_records, guild_id, records)
+            totals["batches"] += 1
+            totals["confessions"] += report["confessions"]
+            totals["existing"] += report["existing"]
+            totals["settings"] += len(report["settings"])
+            # Storage only took what it didn't have; memory does the same.
+            if report["channel_id"] is not None and guild_id not in self.guild_map:
+                self.guild_map[guild_id] = report["channel_id"]
+                totals["channel"] = True
+            for key, value in report["settings"].items():
+                self.guild_settings.setdefault(guild_id, {}).setdefault(key, value)
+            if report["next_code"] is not None and guild_id in self._next_code:
+                async with self._code_locks.setdefault(guild_id, asyncio.Lock()):
+                    if self._next_code.get(guild_id, report["next_code"]) < report["next_code"]:
+                        # The reserved block overlaps imported numbers; reserve a new one.
+                        del self._next_code[guild_id]
+
+    def _take_batch(self):
+        batch = {
+            "guilds": {gid: self.guild_map[gid] for gid in self._dirty_guilds},
+            "confessions": {key: self.confessions[key] for key in self._dirty_confessions},
+            "settings": {(gid, key): self.guild_settings[gid][key] for gid, key in self._dirty_settings},
+            # None deletes the draft.
+            "drafts": {draft_id: self.drafts.get(draft_id) for draft_id in self._dirty_drafts},
+            "members": self._member_ops,
+            "search": self._search_docs,
+        }
+        self._dirty_guilds = set()
+        self._dirty_confessions = set()
+        self._dirty_settings = set()
+        self._dirty_drafts = set()
+        self._member_ops = []
+        self._search_docs = []
+        return batch
+
+    async def flush(self):
+        if not self.dirty_count:
+            return
+        batch = self._take_batch()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self.storage.write_batch, batch)
+        except Exception as e:
+            # Re-queue the keys; the in-memory values are still current.
+            self._dirty_guilds.update(batch["guilds"])
+            self._dirty_confessions.update(batch["confessions"])
+            self._dirty_settings.update(batch["settings"])
+            self._dirty_drafts.update(batch["drafts"])
+            self._member_ops[:0] = batch["members"]
+            self._search_docs[:0] = batch["search"]
+            print(f"State flush failed, will retry: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            self._expire_drafts()
+            await self.flush()
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.refresh_shared()
+            except Exception as e:
+                print(f"Cluster state sync failed: {e}")
+
+    async def _run_compaction(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"State compaction failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.compaction_interval and self._compaction_task is None:
+            self._compaction_task = asyncio.create_task(self._run_compaction())
+        if self.shared and self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._run_sync())
+
+    async def close(self):
+        for task in (self._task, self._sync_task, self._compaction_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._sync_task = None
+        self._compaction_task = None
+        if self.storage is None:
+            self._executor.shutdown(wait=True)
+            return
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self.storage.close()
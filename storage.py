@@ -0,0 +1,762 @@
+"""
+Storage backends for Whispr state.
+
+Two interchangeable backends share the same interface:
+
+- SQLiteStorage: indexed tables in a WAL-mode database. Every write touches
+  a single row, so posting a confession costs the same no matter how many
+  confessions are stored.
+- JSONStorage: the original flat JSON files. Every write rewrites the whole
+  file; kept for small deployments that prefer plain files.
+
+Confessions are keyed by (guild_id, code) because codes are numbered per
+server.
+
+One-shot migration of the legacy JSON files into SQLite:
+   python storage.py migrate [--db whispr.db] [--legacy-guild GUILD_ID]
+"""
+
+import os
+import re
+import json
+import time
+import heapq
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+CONFESSION_MAP_FILE = "confession_map.json"
+CONFESSION_GUILD_MAP_FILE = "confession_guild_map.json"
+CONFESSION_COUNTERS_FILE = "confession_counters.json"
+CONFESSION_MESSAGE_MAP_FILE = "confession_message_map.json"
+GUILD_SETTINGS_FILE = "confession_guild_settings.json"
+DRAFTS_FILE = "confession_drafts.json"
+HOLDS_FILE = "confession_holds.json"
+
+DEFAULT_DATABASE_FILE = "whispr.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    guild_id INTEGER PRIMARY KEY,
+    next_code INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS confessions (
+    guild_id INTEGER NOT NULL,
+    code INTEGER NOT NULL,
+    author_id INTEGER,
+    channel_id INTEGER,
+    message_id INTEGER,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (guild_id, code)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS confessions_created ON confessions (created_at);
+-- Only confessions that still link to their author, for retention batches.
+CREATE INDEX IF NOT EXISTS confessions_linked ON confessions (guild_id, created_at) WHERE author_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS guild_info (
+    guild_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guild_members (
+    user_id INTEGER NOT NULL,
+    guild_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, guild_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS guild_members_guild ON guild_members (guild_id);
+CREATE TABLE IF NOT EXISTS guild_settings (
+    guild_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (guild_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS drafts (
+    draft_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    code INTEGER,
+    content TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+-- Confessions and replies waiting for moderator review. Ids are global so
+-- processes sharing the database never hand out the same one.
+CREATE TABLE IF NOT EXISTS holds (
+    hold_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    code INTEGER,
+    author_id INTEGER,
+    content TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    held_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS holds_guild ON holds (guild_id, hold_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    content,
+    guild,
+    kind UNINDEXED,
+    code UNINDEXED,
+    channel_id UNINDEXED,
+    message_id UNINDEXED,
+    created_at UNINDEXED
+);
+"""
+
+_SEARCH_TOKEN = re.compile(r"\w+")
+
+
+def search_query(guild_id, terms):
+    """FTS5 query matching every word of terms within one guild, or None.
+
+    Each word is quoted so user input can't inject FTS5 syntax; the guild is
+    an indexed column so the filter is resolved by the index too.
+    """
+    words = _SEARCH_TOKEN.findall(terms)
+    if not words:
+        return None
+    quoted = " ".join(f'"{word}"' for word in words)
+    return f'guild : "g{guild_id}" AND content : ({quoted})'
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_json_atomic(path, data):
+    # Write a sibling temp file and rename it over the original so a crash
+    # mid-write never leaves a truncated file behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SQLiteStorage:
+    def __init__(self, path=DEFAULT_DATABASE_FILE):
+        self.path = path
+        # isolation_level=None: transactions are opened explicitly so that
+        # read-modify-write sequences can take the write lock up front.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # FULL so a committed confession-number reservation survives power
+        # loss; batched writes keep the number of commits low.
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get_meta(self, key):
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def load_snapshot(self, since=None):
+        """Load state; with since, only confessions created at or after it."""
+        confessions = {}
+        for guild_id, code, author_id, channel_id, message_id, created_at in self._query(
+            "SELECT guild_id, code, author_id, channel_id, message_id, created_at FROM confessions "
+            "WHERE created_at >= ?",
+            (since if since is not None else float("-inf"),)
+        ):
+            confessions[(guild_id, code)] = {
+                "author_id": author_id,
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "created_at": created_at,
+            }
+        drafts = {}
+        for draft_id, user_id, kind, code, content, expires_at in self._query(
+            "SELECT draft_id, user_id, kind, code, content, expires_at FROM drafts WHERE expires_at > ?",
+            (time.time(),)
+        ):
+            drafts[draft_id] = {
+                "user_id": user_id,
+                "kind": kind,
+                "code": code,
+                "content": content,
+                "expires_at": expires_at,
+            }
+        return {
+            "guilds": dict(self._query("SELECT guild_id, channel_id FROM guilds")),
+            "confessions": confessions,
+            "settings": self.load_guild_settings(),
+            "drafts": drafts,
+        }
+
+    def write_batch(self, batch):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO guilds (guild_id, channel_id) VALUES (?, ?) "
+                "ON CONFLICT(guild_id) DO UPDATE SET channel_id = excluded.channel_id",
+                batch["guilds"].items()
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO confessions "
+                "(guild_id, code, author_id, channel_id, message_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(gid, code, c["author_id"], c["channel_id"], c["message_id"], c["created_at"])
+                 for (gid, code), c in batch["confessions"].items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?)",
+                [(gid, key, json.dumps(value)) for (gid, key), value in batch["settings"].items()]
+            )
+            drafts = batch.get("drafts", {})
+            conn.executemany(
+                "INSERT OR REPLACE INTO drafts (draft_id, user_id, kind, code, content, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(draft_id, d["user_id"], d["kind"], d["code"], d["content"], d["expires_at"])
+                 for draft_id, d in drafts.items() if d is not None]
+            )
+            conn.executemany(
+                "DELETE FROM drafts WHERE draft_id = ?",
+                [(draft_id,) for draft_id, d in drafts.items() if d is None]
+            )
+            if drafts:
+                # Also drops drafts that expired while the bot was down.
+                conn.execute("DELETE FROM drafts WHERE expires_at <= ?", (time.time(),))
+            conn.executemany(
+                "INSERT INTO search_index (content, guild, kind, code, channel_id, message_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(d["content"], f"g{d['guild_id']}", d["kind"], d["code"], d["channel_id"], d["message_id"], d["created_at"])
+                 for d in batch.get("search", ())]
+            )
+            for op in batch.get("members", ()):
+                self._apply_member_op(conn, op)
+
+    def _apply_member_op(self, conn, op):
+        kind, guild_id = op[0], op[1]
+        if kind == "replace":
+            name, member_ids = op[2], op[3]
+            conn.execute("DELETE FROM guild_members WHERE guild_id = ?", (guild_id,))
+            if name is None:
+                conn.execute("DELETE FROM guild_info WHERE guild_id = ?", (guild_id,))
+                return
+            conn.execute("INSERT OR REPLACE INTO guild_info (guild_id, name) VALUES (?, ?)", (guild_id, name))
+            conn.executemany(
+                "INSERT OR IGNORE INTO guild_members (user_id, guild_id) VALUES (?, ?)",
+                ((user_id, guild_id) for user_id in member_ids)
+            )
+        elif kind == "add":
+            conn.execute("INSERT OR IGNORE INTO guild_members (user_id, guild_id) VALUES (?, ?)", (op[2], guild_id))
+        elif kind == "remove":
+            conn.execute("DELETE FROM guild_members WHERE user_id = ? AND guild_id = ?", (op[2], guild_id))
+
+    def load_guild_directory(self):
+        """guild_id -> (channel_id, name) for every configured guild."""
+        rows = self._query(
+            "SELECT guilds.guild_id, guilds.channel_id, guild_info.name FROM guilds "
+            "LEFT JOIN guild_info ON guild_info.guild_id = guilds.guild_id"
+        )
+        return {guild_id: (channel_id, name) for guild_id, channel_id, name in rows}
+
+    def load_guild_settings(self):
+        settings = {}
+        for guild_id, key, value in self._query("SELECT guild_id, key, value FROM guild_settings"):
+            settings.setdefault(guild_id, {})[key] = json.loads(value)
+        return settings
+
+    def get_member_guild_ids(self, user_id):
+        return [row[0] for row in self._query("SELECT guild_id FROM guild_members WHERE user_id = ?", (user_id,))]
+
+    def get_confession(self, guild_id, code):
+        rows = self._query(
+            "SELECT author_id, channel_id, message_id, created_at FROM confessions "
+            "WHERE guild_id = ? AND code = ?",
+            (guild_id, code)
+        )
+        if not rows:
+            return None
+        author_id, channel_id, message_id, created_at = rows[0]
+        return {
+            "author_id": author_id,
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "created_at": created_at,
+        }
+
+    def add_hold(self, guild_id, hold, limit):
+        """Store a held confession or reply and return its id; past limit
+        holds in the guild, the oldest are dropped."""
+        with self.transaction() as conn:
+            hold_id = conn.execute(
+                "INSERT INTO holds (guild_id, kind, code, author_id, content, reason, held_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (guild_id, hold["kind"], hold["code"], hold["author_id"], hold["content"], hold["reason"], hold["held_at"])
+            ).lastrowid
+            conn.execute(
+                "DELETE FROM holds WHERE guild_id = ? AND hold_id NOT IN "
+                "(SELECT hold_id FROM holds WHERE guild_id = ? ORDER BY hold_id DESC LIMIT ?)",
+                (guild_id, guild_id, limit)
+            )
+        return hold_id
+
+    def list_holds(self, guild_id, limit):
+        """(total, [(hold_id, hold), ...]) with the oldest limit holds of a guild."""
+        total = self._query("SELECT COUNT(*) FROM holds WHERE guild_id = ?", (guild_id,))[0][0]
+        rows = self._query(
+            "SELECT hold_id, kind, code, author_id, content, reason, held_at FROM holds "
+            "WHERE guild_id = ? ORDER BY hold_id LIMIT ?",
+            (guild_id, limit)
+        )
+        return total, [(row[0], self._hold(row[1:])) for row in rows]
+
+    def pop_hold(self, guild_id, hold_id):
+        """Remove and return a hold, or None. Atomic, so two admins can't both approve it."""
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT kind, code, author_id, content, reason, held_at FROM holds WHERE guild_id = ? AND hold_id = ?",
+                (guild_id, hold_id)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM holds WHERE hold_id = ?", (hold_id,))
+        return self._hold(row)
+
+    @staticmethod
+    def _hold(row):
+        kind, code, author_id, content, reason, held_at = row
+        return {"kind": kind, "code": code, "author_id": author_id, "content": content, "reason": reason, "held_at": held_at}
+
+    def search(self, guild_id, terms, limit, offset=0):
+        """Best-matching confessions and replies of a guild, each with a highlighted snippet."""
+        query = search_query(guild_id, terms)
+        if query is None:
+            return []
+        rows = self._query(
+            "SELECT kind, code, channel_id, message_id, created_at, "
+            "snippet(search_index, 0, '**', '**', '…', 16) FROM search_index "
+            "WHERE search_index MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+            (query, limit, offset)
+        )
+        return [
+            {"kind": kind, "code": code, "channel_id": channel_id, "message_id": message_id,
+             "created_at": created_at, "snippet": snippet}
+            for kind, code, channel_id, message_id, created_at, snippet in rows
+        ]
+
+    def expire_authors(self, guild_id, before, limit):
+        """Unlink up to limit confessions created before the cutoff from their authors."""
+        with self.transaction() as conn:
+            return conn.execute(
+                "UPDATE confessions SET author_id = NULL WHERE (guild_id, code) IN ("
+                "SELECT guild_id, code FROM confessions "
+                "WHERE guild_id = ? AND created_at < ? AND author_id IS NOT NULL LIMIT ?)",
+                (guild_id, before, limit)
+            ).rowcount
+
+    def prune_search(self, guild_id, before, after_rowid, limit):
+        """Delete a guild's indexed text older than the cutoff, walking rowids upwards.
+
+        Returns (deleted, last_rowid, done). Rowids grow with posting time, so
+        the walk is done at the first document newer than the cutoff.
+        """
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT rowid, created_at FROM search_index "
+                "WHERE search_index MATCH ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                (f'guild : "g{guild_id}"', after_rowid, limit)
+            ).fetchall()
+            expired = [(rowid,) for rowid, created_at in rows if created_at < before]
+            conn.executemany("DELETE FROM search_index WHERE rowid = ?", expired)
+        done = len(rows) < limit or len(expired) < len(rows)
+        last_rowid = expired[-1][0] if expired else after_rowid
+        return len(expired), last_rowid, done
+
+    def export_guild_config(self, guild_id):
+        """Confession channel, next confession number and settings of one guild."""
+        channel = self._query("SELECT channel_id FROM guilds WHERE guild_id = ?", (guild_id,))
+        counter = self._query("SELECT next_code FROM counters WHERE guild_id = ?", (guild_id,))
+        settings = self._query("SELECT key, value FROM guild_settings WHERE guild_id = ?", (guild_id,))
+        return {
+            "channel_id": channel[0][0] if channel else None,
+            "next_code": counter[0][0] if counter else None,
+            "settings": {key: json.loads(value) for key, value in settings},
+        }
+
+    def export_confessions(self, guild_id, after_code, limit):
+        """Up to limit confessions of a guild numbered above after_code, in order."""
+        rows = self._query(
+            "SELECT code, author_id, channel_id, message_id, created_at FROM confessions "
+            "WHERE guild_id = ? AND code > ? ORDER BY code LIMIT ?",
+            (guild_id, after_code, limit)
+        )
+        return [
+            {"code": code, "author_id": author_id, "channel_id": channel_id,
+             "message_id": message_id, "created_at": created_at}
+            for code, author_id, channel_id, message_id, created_at in rows
+        ]
+
+    def import_records(self, guild_id, records):
+        """Apply a batch of export records in one transaction, keeping anything already stored.
+
+        The guild's counter is raised past every imported confession number.
+        Returns what was added: {"confessions", "existing", "channel_id",
+        "settings", "next_code"}.
+        """
+        report = {"confessions": 0, "existing": 0, "channel_id": None, "settings": {}, "next_code": None}
+        next_code = 0
+        now = time.time()
+        with self.transaction() as conn:
+            for record in records:
+                kind = record["type"]
+                if kind == "confession":
+                    added = conn.execute(
+                        "INSERT OR IGNORE INTO confessions "
+                        "(guild_id, code, author_id, channel_id, message_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (guild_id, record["code"], record.get("author_id"), record.get("channel_id"),
+                         record.get("message_id"), record.get("created_at") or now)
+                    ).rowcount
+                    report["confessions" if added else "existing"] += 1
+                    next_code = max(next_code, record["code"] + 1)
+                elif kind == "guild":
+                    if conn.execute(
+                        "INSERT OR IGNORE INTO guilds (guild_id, channel_id) VALUES (?, ?)",
+                        (guild_id, record["channel_id"])
+                    ).rowcount:
+                        report["channel_id"] = record["channel_id"]
+                elif kind == "counter":
+                    next_code = max(next_code, record["next_code"])
+                elif kind == "setting":
+                    if conn.execute(
+                        "INSERT OR IGNORE INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?)",
+                        (guild_id, record["key"], json.dumps(record["value"]))
+                    ).rowcount:
+                        report["settings"][record["key"]] = record["value"]
+            if next_code:
+                conn.execute(
+                    "INSERT INTO counters (guild_id, next_code) VALUES (?, ?) "
+                    "ON CONFLICT(guild_id) DO UPDATE SET next_code = MAX(next_code, excluded.next_code)",
+                    (guild_id, next_code)
+                )
+                report["next_code"] = conn.execute(
+                    "SELECT next_code FROM counters WHERE guild_id = ?", (guild_id,)
+                ).fetchone()[0]
+        return report
+
+    def reserve_codes(self, guild_id, count):
+        """Durably reserve count confession numbers; returns the first one."""
+        with self.transaction() as conn:
+            row = conn.execute("SELECT next_code FROM counters WHERE guild_id = ?", (guild_id,)).fetchone()
+            start = row[0] if row else 1
+            conn.execute(
+                "INSERT INTO counters (guild_id, next_code) VALUES (?, ?) "
+                "ON CONFLICT(guild_id) DO UPDATE SET next_code = excluded.next_code",
+                (guild_id, start + count)
+            )
+        return start
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class JSONStorage:
+    def __init__(self, directory="."):
+        self.directory = directory
+        self._files = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load_snapshot(self, since=None):
+        # The JSON files carry no timestamps, so everything is loaded.
+        self._files = {
+            name: _read_json(self._path(name))
+            for name in (CONFESSION_GUILD_MAP_FILE, CONFESSION_COUNTERS_FILE,
+                         CONFESSION_MAP_FILE, CONFESSION_MESSAGE_MAP_FILE, GUILD_SETTINGS_FILE, DRAFTS_FILE, HOLDS_FILE)
+        }
+        self._files[HOLDS_FILE].setdefault("next_id", 1)
+        self._files[HOLDS_FILE].setdefault("holds", {})
+        confession_map = self._files[CONFESSION_MAP_FILE]
+        now = time.time()
+        drafts = self._files[DRAFTS_FILE] = {
+            draft_id: draft for draft_id, draft in self._files[DRAFTS_FILE].items() if draft["expires_at"] > now
+        }
+        message_map = self._files[CONFESSION_MESSAGE_MAP_FILE]
+
+        confessions = {}
+        # Plain-code keys predate per-guild keys and can't be attributed.
+        for key in set(confession_map) | set(message_map):
+            if ":" not in key:
+                continue
+            guild_id, code = (int(part) for part in key.split(":", 1))
+            channel_id, message_id = message_map.get(key, (None, None))
+            confessions[(guild_id, code)] = {
+                "author_id": confession_map.get(key),
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "created_at": None,
+            }
+        return {
+            "guilds": {int(gid): cid for gid, cid in self._files[CONFESSION_GUILD_MAP_FILE].items()},
+            "confessions": confessions,
+            "settings": {int(gid): settings for gid, settings in self._files[GUILD_SETTINGS_FILE].items()},
+            "drafts": {int(draft_id): draft for draft_id, draft in drafts.items()},
+        }
+
+    def write_batch(self, batch):
+        # Each file is still written whole, but only when it has changes and
+        # at most once per batch.
+        touched = set()
+        for guild_id, channel_id in batch["guilds"].items():
+            self._files[CONFESSION_GUILD_MAP_FILE][str(guild_id)] = channel_id
+            touched.add(CONFESSION_GUILD_MAP_FILE)
+        for (guild_id, code), confession in batch["confessions"].items():
+            key = f"{guild_id}:{code}"
+            self._files[CONFESSION_MAP_FILE][key] = confession["author_id"]
+            self._files[CONFESSION_MESSAGE_MAP_FILE][key] = [confession["channel_id"], confession["message_id"]]
+            touched.update((CONFESSION_MAP_FILE, CONFESSION_MESSAGE_MAP_FILE))
+        for (guild_id, key), value in batch["settings"].items():
+            self._files[GUILD_SETTINGS_FILE].setdefault(str(guild_id), {})[key] = value
+            touched.add(GUILD_SETTINGS_FILE)
+        for draft_id, draft in batch.get("drafts", {}).items():
+            if draft is None:
+                self._files[DRAFTS_FILE].pop(str(draft_id), None)
+            else:
+                self._files[DRAFTS_FILE][str(draft_id)] = draft
+            touched.add(DRAFTS_FILE)
+        for name in touched:
+            _write_json_atomic(self._path(name), self._files[name])
+
+    def add_hold(self, guild_id, hold, limit):
+        holds_file = self._files[HOLDS_FILE]
+        hold_id = holds_file["next_id"]
+        holds_file["next_id"] += 1
+        holds = holds_file["holds"]
+        holds[str(hold_id)] = dict(hold, guild_id=guild_id)
+        guild_holds = sorted(int(key) for key, held in holds.items() if held["guild_id"] == guild_id)
+        for old_id in guild_holds[:-limit]:
+            del holds[str(old_id)]
+        _write_json_atomic(self._path(HOLDS_FILE), holds_file)
+        return hold_id
+
+    def list_holds(self, guild_id, limit):
+        entries = sorted(
+            (int(key), {k: v for k, v in held.items() if k != "guild_id"})
+            for key, held in self._files[HOLDS_FILE]["holds"].items() if held["guild_id"] == guild_id
+        )
+        return len(entries), entries[:limit]
+
+    def pop_hold(self, guild_id, hold_id):
+        holds_file = self._files[HOLDS_FILE]
+        held = holds_file["holds"].get(str(hold_id))
+        if held is None or held["guild_id"] != guild_id:
+            return None
+        del holds_file["holds"][str(hold_id)]
+        _write_json_atomic(self._path(HOLDS_FILE), holds_file)
+        return {k: v for k, v in held.items() if k != "guild_id"}
+
+    def get_confession(self, guild_id, code):
+        key = f"{guild_id}:{code}"
+        message_map = self._files[CONFESSION_MESSAGE_MAP_FILE]
+        if key not in self._files[CONFESSION_MAP_FILE] and key not in message_map:
+            return None
+        channel_id, message_id = message_map.get(key, (None, None))
+        return {
+            "author_id": self._files[CONFESSION_MAP_FILE].get(key),
+            "channel_id": channel_id,
+            "message_id": message_id,
+            "created_at": None,
+        }
+
+    def export_guild_config(self, guild_id):
+        return {
+            "channel_id": self._files[CONFESSION_GUILD_MAP_FILE].get(str(guild_id)),
+            "next_code": self._files[CONFESSION_COUNTERS_FILE].get(str(guild_id)),
+            "settings": dict(self._files[GUILD_SETTINGS_FILE].get(str(guild_id), {})),
+        }
+
+    def export_confessions(self, guild_id, after_code, limit):
+        prefix = f"{guild_id}:"
+        keys = set(self._files[CONFESSION_MAP_FILE]) | set(self._files[CONFESSION_MESSAGE_MAP_FILE])
+        codes = heapq.nsmallest(limit, (
+            int(key[len(prefix):]) for key in keys if key.startswith(prefix) and int(key[len(prefix):]) > after_code
+        ))
+        return [dict(self.get_confession(guild_id, code), code=code) for code in codes]
+
+    def import_records(self, guild_id, records):
+        report = {"confessions": 0, "existing": 0, "channel_id": None, "settings": {}, "next_code": None}
+        next_code = 0
+        touched = set()
+        for record in records:
+            kind = record["type"]
+            if kind == "confession":
+                key = f"{guild_id}:{record['code']}"
+                next_code = max(next_code, record["code"] + 1)
+                if key in self._files[CONFESSION_MAP_FILE] or key in self._files[CONFESSION_MESSAGE_MAP_FILE]:
+                    report["existing"] += 1
+                    continue
+                self._files[CONFESSION_MAP_FILE][key] = record.get("author_id")
+                self._files[CONFESSION_MESSAGE_MAP_FILE][key] = [record.get("channel_id"), record.get("message_id")]
+                touched.update((CONFESSION_MAP_FILE, CONFESSION_MESSAGE_MAP_FILE))
+                report["confessions"] += 1
+            elif kind == "guild":
+                if str(guild_id) not in self._files[CONFESSION_GUILD_MAP_FILE]:
+                    self._files[CONFESSION_GUILD_MAP_FILE][str(guild_id)] = record["channel_id"]
+                    touched.add(CONFESSION_GUILD_MAP_FILE)
+                    report["channel_id"] = record["channel_id"]
+            elif kind == "counter":
+                next_code = max(next_code, record["next_code"])
+            elif kind == "setting":
+                settings = self._files[GUILD_SETTINGS_FILE].setdefault(str(guild_id), {})
+                if record["key"] not in settings:
+                    settings[record["key"]] = record["value"]
+                    touched.add(GUILD_SETTINGS_FILE)
+                    report["settings"][record["key"]] = record["value"]
+        if next_code:
+            counters = self._files[CONFESSION_COUNTERS_FILE]
+            counters[str(guild_id)] = report["next_code"] = max(counters.get(str(guild_id), 1), next_code)
+            touched.add(CONFESSION_COUNTERS_FILE)
+        for name in touched:
+            _write_json_atomic(self._path(name), self._files[name])
+        return report
+
+    def reserve_codes(self, guild_id, count):
+        """Durably reserve count confession numbers; returns the first one."""
+        counters = self._files[CONFESSION_COUNTERS_FILE]
+        start = counters.get(str(guild_id), 1)
+        counters[str(guild_id)] = start + count
+        _write_json_atomic(self._path(CONFESSION_COUNTERS_FILE), counters)
+        return start
+
+    def close(self):
+        pass
+
+
+def legacy_json_exists(directory="."):
+    return any(
+        os.path.exists(os.path.join(directory, name))
+        for name in (CONFESSION_GUILD_MAP_FILE, CONFESSION_COUNTERS_FILE, CONFESSION_MAP_FILE)
+    )
+
+
+def migrate_json_to_sqlite(storage, directory=".", legacy_guild_id=None):
+    """Copy the legacy JSON files into a SQLiteStorage in one transaction.
+
+    The old confession map was keyed by code alone. A plain-code entry is
+    assigned to legacy_guild_id when given, otherwise to the only guild whose
+    counter had reached that code; entries that could belong to several
+    guilds are skipped rather than risk notifying the wrong person.
+    """
+    guild_map = _read_json(os.path.join(directory, CONFESSION_GUILD_MAP_FILE))
+    counters = _read_json(os.path.join(directory, CONFESSION_COUNTERS_FILE))
+    confession_map = _read_json(os.path.join(directory, CONFESSION_MAP_FILE))
+    message_map = _read_json(os.path.join(directory, CONFESSION_MESSAGE_MAP_FILE))
+
+    confessions = {}
+    skipped = 0
+    for key, author_id in confession_map.items():
+        if ":" in key:
+            guild_id, code = (int(part) for part in key.split(":", 1))
+        else:
+            code = int(key)
+            if legacy_guild_id is not None:
+                guild_id = legacy_guild_id
+            else:
+                candidates = [int(gid) for gid, next_code in counters.items() if next_code > code]
+                if len(candidates) != 1:
+                    skipped += 1
+                    continue
+                guild_id = candidates[0]
+        confessions[(guild_id, code)] = [author_id, None, None]
+    for key, (channel_id, message_id) in message_map.items():
+        guild_id, code = (int(part) for part in key.split(":", 1))
+        entry = confessions.setdefault((guild_id, code), [None, None, None])
+        entry[1], entry[2] = channel_id, message_id
+
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO guilds (guild_id, channel_id) VALUES (?, ?)",
+            [(int(gid), channel_id) for gid, channel_id in guild_map.items()]
+        )
+        conn.executemany(
+            "INSERT INTO counters (guild_id, next_code) VALUES (?, ?) "
+            "ON CONFLICT(guild_id) DO UPDATE SET next_code = MAX(next_code, excluded.next_code)",
+            [(int(gid), next_code) for gid, next_code in counters.items()]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO confessions "
+            "(guild_id, code, author_id, channel_id, message_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(gid, code, author_id, channel_id, message_id, now)
+             for (gid, code), (author_id, channel_id, message_id) in confessions.items()]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+            (str(now),)
+        )
+
+    return {
+        "guilds": len(guild_map),
+        "counters": len(counters),
+        "confessions": len(confessions),
+        "skipped_ambiguous": skipped,
+    }
+
+
+def open_storage(backend=None, path=None, directory="."):
+    backend = backend or os.getenv("STORAGE_BACKEND", "sqlite")
+    if backend == "json":
+        return JSONStorage(directory)
+    if backend != "sqlite":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}")
+
+    storage = SQLiteStorage(path or os.getenv("DATABASE_FILE", DEFAULT_DATABASE_FILE))
+    if storage.get_meta("json_migrated") is None and legacy_json_exists(directory):
+        report = migrate_json_to_sqlite(storage, directory)
+        print(f"Migrated legacy JSON state into {storage.path}: {report}")
+    return storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whispr storage utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="copy the legacy JSON files into SQLite")
+    migrate.add_argument("--db", default=os.getenv("DATABASE_FILE", DEFAULT_DATABASE_FILE))
+    migrate.add_argument("--dir", default=".", help="directory holding the JSON files")
+    migrate.add_argument("--legacy-guild", type=int, help="guild that owns plain-code confession entries")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        storage = SQLiteStorage(args.db)
+        report = migrate_json_to_sqlite(storage, args.dir, args.legacy_guild)
+        storage.close()
+        print(f"Migrated into {args.db}: {report}")
+
+
+if __name__ == "__main__":
+    main()
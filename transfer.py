@@ -0,0 +1,258 @@
+"""
+Streaming export and import of one guild's Whispr data.
+
+An export is gzip-compressed JSON Lines: a header line, then the guild's
+confession channel, next confession number and settings, then one line per
+confession with its message location and author link. Big exports are
+split into parts that each fit in a Discord attachment; every part is a
+complete file with its own header, and parts can be imported in any order.
+
+Neither direction holds more than one batch of lines in memory: export
+pages through storage by confession number and writes each page straight
+into the gzip stream, and import reads the file a batch at a time. Import
+never overwrites what the target already has, so repeating one is harmless.
+"""
+
+import io
+import os
+import gzip
+import json
+import time
+
+from ratelimit import DEFAULT_POLICIES
+from moderation import (
+    DUPLICATE_ACTIONS, MAX_DISTANCE, FILTER_ACTIONS, MAX_FILTER_WORDS, MAX_FILTER_PATTERNS,
+    normalize_word, validate_pattern,
+)
+
+EXPORT_FORMAT = "whispr-guild-export"
+EXPORT_VERSION = 1
+TRANSFER_BATCH = int(os.getenv("TRANSFER_BATCH", "500"))
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(8 * 2 ** 20)))
+# The compressor holds back some output, so parts are closed this far below the limit.
+PART_MARGIN = 2 ** 20
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+class TransferError(Exception):
+    """Raised for a file that isn't a usable export of this guild."""
+
+
+class ExportWriter:
+    """Writes export records into one or more .jsonl.gz parts in a directory.
+
+    write_* and close do blocking file I/O; run them in an executor.
+    """
+    def __init__(self, directory, guild_id, part_size=EXPORT_PART_SIZE):
+        self.directory = directory
+        self.guild_id = guild_id
+        self.part_size = max(part_size - PART_MARGIN, PART_MARGIN)
+        self.exported_at = time.time()
+        self.paths = []
+        self.records = 0
+        self._raw = None
+        self._text = None
+
+    def _start_part(self):
+        self._close_part()
+        path = os.path.join(self.directory, f"whispr-{self.guild_id}-part{len(self.paths) + 1}.jsonl.gz")
+        self._raw = open(path, "wb")
+        self._text = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode="wb"), encoding="utf-8")
+        self.paths.append(path)
+        self._write_line({
+            "type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION,
+            "guild_id": self.guild_id, "part": len(self.paths), "exported_at": self.exported_at,
+        })
+
+    def _close_part(self):
+        if self._text is not None:
+            self._text.close()    # also closes the gzip stream
+            self._raw.close()
+            self._text = self._raw = None
+
+    def _write_line(self, record):
+        self._text.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _write(self, records):
+        for record in records:
+            if self._text is None or self._raw.tell() >= self.part_size:
+                self._start_part()
+            self._write_line(record)
+            self.records += 1
+
+    def write_config(self, config):
+        records = []
+        if config["channel_id"] is not None:
+            records.append({"type": "guild", "channel_id": config["channel_id"]})
+        if config["next_code"] is not None:
+            records.append({"type": "counter", "next_code": config["next_code"]})
+        for key, value in config["settings"].items():
+            records.append({"type": "setting", "key": key, "value": value})
+        if not self.paths:
+            self._start_part()
+        self._write(records)
+
+    def write_confessions(self, confessions):
+        self._write(dict(confession, type="confession") for confession in confessions)
+
+    def close(self):
+        self._close_part()
+
+
+def _is_int(value, minimum):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+
+def _is_id(value, optional=True):
+    return (value is None and optional) or _is_int(value, 1)
+
+
+# Imported settings are used on every DM without further checks, so each one
+# must pass the same bounds as the admin command that sets it.
+
+def _check_rate_limit(value):
+    if not (isinstance(value, list) and len(value) == 2 and all(_is_int(part, 1) for part in value)):
+        return "a rate limit must be [count, seconds], both at least 1"
+    return None
+
+
+def _check_duplicates(value):
+    if not isinstance(value, dict) or not set(value) <= {"action", "distance", "window"}:
+        return "unknown duplicate policy fields"
+    if "action" in value and value["action"] not in DUPLICATE_ACTIONS:
+        return "unknown duplicate action"
+    if "distance" in value and not (_is_int(value["distance"], 0) and value["distance"] <= MAX_DISTANCE):
+        return f"duplicate distance must be between 0 and {MAX_DISTANCE}"
+    if "window" in value and not _is_int(value["window"], 1):
+        return "duplicate window must be at least 1 second"
+    return None
+
+
+def _check_retention(value):
+    if not isinstance(value, dict) or not set(value) <= {"author_days", "content_days"}:
+        return "unknown retention fields"
+    if not all(days is None or _is_int(days, 1) for days in value.values()):
+        return "retention days must be at least 1"
+    return None
+
+
+def _check_filter(value):
+    if not isinstance(value, dict) or set(value) != {"version", "words", "patterns"}:
+        return "a content filter needs version, words and patterns"
+    words, patterns = value["words"], value["patterns"]
+    if not (_is_int(value["version"], 0) and isinstance(words, dict) and isinstance(patterns, dict)):
+        return "malformed content filter"
+    if len(words) > MAX_FILTER_WORDS or len(patterns) > MAX_FILTER_PATTERNS:
+        return f"a content filter can have at most {MAX_FILTER_WORDS} words and {MAX_FILTER_PATTERNS} regex rules"
+    if not all(action in FILTER_ACTIONS for action in list(words.values()) + list(patterns.values())):
+        return "unknown content filter action"
+    if not all(word and normalize_word(word) == word for word in words):
+        return "content filter words must be lowercase with single spaces"
+    for pattern in patterns:
+        problem = validate_pattern(pattern)
+        if problem is not None:
+            return f"can't use content filter pattern {pattern!r}: {problem}"
+    return None
+
+
+SETTING_CHECKS = {
+    **{f"rate_limit_{kind}": _check_rate_limit for kind in DEFAULT_POLICIES},
+    "duplicates": _check_duplicates,
+    "retention": _check_retention,
+    "filter": _check_filter,
+}
+
+
+def validate_record(record):
+    """Return why an import line can't be used, or None if it can."""
+    if not isinstance(record, dict):
+        return "not a JSON object"
+    kind = record.get("type")
+    if kind == "confession":
+        if not _is_id(record.get("code"), optional=False):
+            return "confession without a valid code"
+        if not all(_is_id(record.get(field)) for field in ("author_id", "channel_id", "message_id")):
+            return "confession with an invalid id"
+        created_at = record.get("created_at")
+        if created_at is not None and not isinstance(created_at, (int, float)):
+            return "confession with an invalid created_at"
+    elif kind == "guild":
+        if not _is_id(record.get("channel_id"), optional=False):
+            return "guild without a valid channel_id"
+    elif kind == "counter":
+        if not _is_id(record.get("next_code"), optional=False):
+            return "counter without a valid next_code"
+    elif kind == "setting":
+        check = SETTING_CHECKS.get(record.get("key"))
+        if check is None:
+            return f"unknown setting {record.get('key')!r}"
+        if "value" not in record:
+            return "setting without a value"
+        return check(record["value"])
+    else:
+        return f"unknown record type {kind!r}"
+    return None
+
+
+class ImportReader:
+    """Reads an export part (gzip or plain JSON Lines) a batch at a time.
+
+    Opening it checks the header; next_batch raises TransferError at the
+    first bad line. Both do blocking file I/O; run them in an executor.
+    """
+    def __init__(self, path, guild_id, batch_size=TRANSFER_BATCH):
+        self.batch_size = batch_size
+        self.line_number = 0
+        with open(path, "rb") as f:
+            compressed = f.read(2) == _GZIP_MAGIC
+        opener = gzip.open if compressed else open
+        self._file = opener(path, "rt", encoding="utf-8")
+        try:
+            self._read_header(guild_id)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def _read_header(self, guild_id):
+        try:
+            header = json.loads(self._next_line() or "null")
+        except (ValueError, OSError, EOFError):
+            raise TransferError("this isn't a Whispr export file")
+        if not isinstance(header, dict) or header.get("format") != EXPORT_FORMAT:
+            raise TransferError("this isn't a Whispr export file")
+        if header.get("version") != EXPORT_VERSION:
+            raise TransferError(f"export format version {header.get('version')} isn't supported")
+        if header.get("guild_id") != guild_id:
+            # Channel and message ids only mean something in the server they came from.
+            raise TransferError(f"this export belongs to server {header.get('guild_id')}, not this one")
+        self.header = header
+
+    def _next_line(self):
+        self.line_number += 1
+        return self._file.readline()
+
+    def next_batch(self):
+        """Return up to batch_size records; an empty list at the end of the file."""
+        records = []
+        while len(records) < self.batch_size:
+            try:
+                line = self._next_line()
+            except (OSError, EOFError, UnicodeDecodeError):
+                raise TransferError(f"the file is damaged at line {self.line_number}")
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise TransferError(f"line {self.line_number} isn't valid JSON")
+            problem = validate_record(record)
+            if problem is not None:
+                raise TransferError(f"line {self.line_number}: {problem}")
+            records.append(record)
+        return records
+
+    def close(self):
+        self._file.close()